@@ -1,43 +1,93 @@
+import json
+import os
+import time
+from urllib.parse import urlsplit
+
 import httpx
+from ruamel.yaml import YAML
 
-from m3u_utils import generate_playlist, parse_playlist
+import metrics
+from m3u_utils import generate_playlist, iter_playlist
+from output_utils import write_output
 
+# DrewLive's tvg-ids aren't in our database, so they keep the upstream guide
+drewlive_epg_url: str = "https://epgshare01.online/epgshare01/epg_ripper_US2.xml.gz"
 drewlive_url: str = "http://drewlive2423.duckdns.org:8081/DrewLive/MergedPlaylist.m3u8"
+drewlive_output: str = "output/playlists/playlist_drewlive.m3u"
+# ETag/Last-Modified of the last download, for conditional requests
+drewlive_state_path: str = "data/drewlive_state.json"
+
+DOWNLOAD_TIMEOUT: httpx.Timeout = httpx.Timeout(30.0, connect=10.0)
+DOWNLOAD_ATTEMPTS: int = 3
+
+
+def load_desired_groups(path: str = "playlists.yaml") -> list[str]:
+    yaml = YAML(typ="safe")
+    with open(path, "r") as f:
+        config = yaml.load(f)
+    return config["drewlive"]["groups"]
+
+
+def load_state(path: str = drewlive_state_path) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_state(state: dict, path: str = drewlive_state_path) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def generate_drewlive_playlist(desired_groups: list[str] | None = None):
+    """
+    Downloads the DrewLive merged playlist and keeps the channels of the
+    desired groups (the `drewlive` section of playlists.yaml).
+
+    The playlist is streamed and filtered while it is parsed. The download is
+    conditional, so nothing is done if upstream hasn't changed since the last
+    run and the desired groups are the same.
+    """
+    if desired_groups is None:
+        desired_groups = load_desired_groups()
+
+    state: dict = load_state()
+    headers: dict[str, str] = {}
+    if state.get("groups") == desired_groups and os.path.exists(drewlive_output):
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    groups: set[str] = set(desired_groups)
+    # Retried by the loop below, which also covers errors mid-download
+    client = httpx.Client(timeout=DOWNLOAD_TIMEOUT, follow_redirects=True)
+    with client, metrics.timed("drewlive_download", urlsplit(drewlive_url).hostname):
+        for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+            try:
+                with client.stream("GET", drewlive_url, headers=headers) as response:
+                    if response.status_code == 304:
+                        print("DrewLive playlist not modified")
+                        return
+                    response.raise_for_status()
 
+                    desired_channels: list[dict] = list(
+                        iter_playlist(response.iter_lines(), group_titles=groups)
+                    )
+                    downloaded: int = response.num_bytes_downloaded
+                    etag: str | None = response.headers.get("ETag")
+                    last_modified: str | None = response.headers.get("Last-Modified")
+                break
+            except httpx.TransportError as e:
+                if attempt == DOWNLOAD_ATTEMPTS:
+                    raise
+                print(f"DrewLive download failed ({e!r}), retrying...")
+                time.sleep(2**attempt)
 
-def generate_drewlive_playlist():
-    playlist: str = httpx.get(drewlive_url).text
-    playlist_data: list[dict] = parse_playlist(playlist)
-
-    desired_grous: list[str] = [
-        "A1xmedia Live Event | PPV",
-        "A1xmedia UHD | 4K",
-        "A1xmedia US Channels",
-        "A1xmedia US Sports",
-        "LGTV - United States",
-        "MoveOnJoy",
-        "PlexTV - United States",
-        "PlutoTV - United States",
-        "PlutoTV",
-        "RokuTV",
-        "Roxiestream - WWE",
-        "SamsungTVPlus - USA",
-        "Sharkstreams - NBA",
-        "Sharkstreams - UFC",
-        "Sharkstreams - WWE",
-        "TubiTV",
-        "Xumo Streams",
-    ]
-    desired_channels: list[dict] = []
-
-    groups: list[str] = []
-    for channel in playlist_data:
-        group_title: str = channel["group-title"]
-        if group_title not in groups:
-            groups.append(group_title)
-
-        if group_title in desired_grous:
-            desired_channels.append(channel)
-
-    with open("output/playlists/playlist_drewlive.m3u", "w", encoding="utf-8") as f:
-        f.write(generate_playlist(desired_channels))
+    print(f"Downloaded {downloaded / 1024:.0f} KiB from DrewLive")
+    metrics.increment("bytes_downloaded", downloaded)
+    write_output(drewlive_output, generate_playlist(desired_channels, drewlive_epg_url))
+    save_state(
+        {"etag": etag, "last_modified": last_modified, "groups": desired_groups}
+    )
@@ -1,10 +1,96 @@
-import os
 import re
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pprint import pprint
+from urllib.parse import parse_qs, urlsplit
 
 import yt_dlp
 
+import metrics
+from logo_mirror import LogoMirror
+from output_utils import write_output
+from rate_limiter import TokenBucket
+from youtube_cache import (
+    get_cached_entry,
+    load_youtube_cache,
+    make_cache_entry,
+    save_youtube_cache,
+)
+
+
+# Maximum number of yt-dlp extractions running at once, to stay under
+# YouTube's rate limits
+MAX_WORKERS: int = 4
+# Shared by all workers: one extraction per second, in bursts of MAX_WORKERS
+EXTRACTION_LIMITER: TokenBucket = TokenBucket(rate=1.0, capacity=MAX_WORKERS)
+# Cached URLs of videos the /streams listing doesn't confirm as live (e.g.
+# LINKS) are only trusted for this long, since the stream may have ended
+UNCONFIRMED_MAX_AGE: int = 3600
+
+LIST_OPTS: dict[str, bool | int | str] = {
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+    "extract_flat": True,
+    "playlistend": 20,
+    "ignoreerrors": True,
+    "cookiefile": "cookies.txt",
+}
+
+# Stop reading a channel's /streams listing after this many past streams in a
+# row; current lives are listed before past ones
+MAX_PAST_ENTRIES: int = 3
+PAST_LIVE_STATUSES: set[str] = {"was_live", "not_live", "post_live"}
+
+VIDEO_OPTS: dict[str, bool | int | str | dict[str, list[str]]] = {
+    "quiet": True,
+    "no_warnings": True,
+    "skip_download": True,
+    # "format": "best",
+    "ignoreerrors": True,
+    "allow_unplayable_formats": True,
+    "extract_flat": False,
+    # "extractor_args": {"youtube": {"player_client": ["android", "tv"]}},
+    "cookiefile": "cookies.txt",
+}
+
+
+class YoutubeDLPool:
+    """
+    Hands out long-lived YoutubeDL instances, one per thread and option set,
+    so worker threads don't build a new extractor (and reload the cookie
+    file) for every video.
+    """
+
+    def __init__(self) -> None:
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._instances: list[yt_dlp.YoutubeDL] = []
+
+    def get(self, opts: dict) -> yt_dlp.YoutubeDL:
+        instances: dict[int, yt_dlp.YoutubeDL] = self._local.__dict__.setdefault(
+            "instances", {}
+        )
+        if id(opts) not in instances:
+            ydl = yt_dlp.YoutubeDL(opts)
+            instances[id(opts)] = ydl
+            with self._lock:
+                self._instances.append(ydl)
+        return instances[id(opts)]
+
+    def close(self) -> None:
+        with self._lock:
+            for ydl in self._instances:
+                ydl.__exit__(None, None, None)
+            self._instances.clear()
+
+    def __enter__(self) -> "YoutubeDLPool":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
 
 def pause() -> None:
     input("Press Enter to continue...")
@@ -51,20 +137,22 @@ def is_live_ydl(video_id: str, debug: bool = False) -> bool:
     return False
 
 
-def get_live_from_url(video_url: str) -> list[dict]:
-    opts: dict[str, bool | int | str | dict[str, list[str]]] = {
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        # "format": "best",
-        "ignoreerrors": True,
-        "allow_unplayable_formats": True,
-        "extract_flat": False,
-        # "extractor_args": {"youtube": {"player_client": ["android", "tv"]}},
-        "cookiefile": "cookies.txt",
-    }
-    with yt_dlp.YoutubeDL(opts) as ydl:
-        e = ydl.extract_info(video_url, download=False)
+def get_video_id(video_url: str) -> str | None:
+    parts = urlsplit(video_url)
+    if parts.hostname == "youtu.be":
+        return parts.path.strip("/") or None
+    return parse_qs(parts.query).get("v", [None])[0]
+
+
+def get_live_from_url(video_url: str, pool: YoutubeDLPool | None = None) -> list[dict]:
+    EXTRACTION_LIMITER.acquire()
+    metrics.increment("yt_dlp_extractions")
+    with metrics.timed("yt_dlp_video", "youtube.com"):
+        if pool is not None:
+            e = pool.get(VIDEO_OPTS).extract_info(video_url, download=False)
+        else:
+            with yt_dlp.YoutubeDL(VIDEO_OPTS) as ydl:
+                e = ydl.extract_info(video_url, download=False)
 
     if not e or not (
         e.get("live_status") == "is_live"
@@ -119,35 +207,76 @@ def get_live_from_url(video_url: str) -> list[dict]:
     ]
 
 
-def get_live_streams(channel: str) -> list[dict]:
+def get_entry_status(entry: dict) -> str:
+    """
+    Classifies a flat /streams listing entry as "live", "upcoming", "past" or
+    "unknown" from the metadata the listing already has.
+    """
+    live_status = entry.get("live_status")
+    if live_status == "is_live":
+        return "live"
+    if live_status == "is_upcoming":
+        return "upcoming"
+    # Finished streams are listed with their duration; running ones have none
+    if live_status in PAST_LIVE_STATUSES or entry.get("duration"):
+        return "past"
+    return "unknown"
+
+
+def get_channel_video_urls(
+    channel: str, pool: YoutubeDLPool | None = None
+) -> dict[str, str]:
+    """
+    Lists the URLs of the videos on a channel's /streams tab that may be live,
+    without extracting them, mapped to their status ("live" or "unknown").
+    Upcoming and past streams are skipped, and the listing is cut off after
+    MAX_PAST_ENTRIES past streams in a row.
+    """
     if channel.startswith("http"):
         channel_url = channel.rstrip("/")
     else:
         handle = channel if channel.startswith("@") else f"@{channel}"
         channel_url = f"https://www.youtube.com/{handle}"
 
-    list_opts = {
-        "quiet": True,
-        "no_warnings": True,
-        "skip_download": True,
-        "extract_flat": True,
-        "playlistend": 20,
-        "ignoreerrors": True,
-        "cookiefile": "cookies.txt",
-    }
-    with yt_dlp.YoutubeDL(list_opts) as ydl:
-        info = ydl.extract_info(channel_url + "/streams", download=False)
-
-    lives = []
-    for e in info.get("entries") or []:
+    streams_url = channel_url + "/streams"
+    EXTRACTION_LIMITER.acquire()
+    metrics.increment("yt_dlp_listings")
+    with metrics.timed("yt_dlp_listing", "youtube.com"):
+        if pool is not None:
+            info = pool.get(LIST_OPTS).extract_info(streams_url, download=False)
+        else:
+            with yt_dlp.YoutubeDL(LIST_OPTS) as ydl:
+                info = ydl.extract_info(streams_url, download=False)
+
+    video_urls = {}
+    past_entries = 0
+    for e in (info or {}).get("entries") or []:
         if not e:
             continue
+        status = get_entry_status(e)
+        if status == "past":
+            past_entries += 1
+            if past_entries >= MAX_PAST_ENTRIES:
+                break
+            continue
+        past_entries = 0
+        if status == "upcoming":
+            continue
+
         vid_id = e.get("id") or e.get("url")
         if not vid_id:
             continue
         video_url = (
             f"https://www.youtube.com/watch?v={vid_id}" if len(vid_id) == 11 else vid_id
         )
+        video_urls[video_url] = status
+
+    return video_urls
+
+
+def get_live_streams(channel: str) -> list[dict]:
+    lives = []
+    for video_url in get_channel_video_urls(channel):
         lives.extend(get_live_from_url(video_url))
 
     return lives
@@ -188,6 +317,22 @@ def lives_to_m3u_dict(lives: list[dict]) -> dict[str, str]:
     return m3u_dicts
 
 
+def mirror_thumbnails(m3u_dicts: list[dict]) -> None:
+    """
+    Mirrors the streams' thumbnails with the channel logos and points the
+    tvg-logo of each stream at its copy.
+    """
+    mirror = LogoMirror()
+    broken = mirror.mirror(m3u_dict["tvg-logo"] for m3u_dict in m3u_dicts)
+    for url, reason in broken.items():
+        print(f"Broken thumbnail ({reason}): {url}")
+    mirror.save()
+
+    logo_urls = mirror.get_logo_urls()
+    for m3u_dict in m3u_dicts:
+        m3u_dict["tvg-logo"] = logo_urls.get(m3u_dict["tvg-logo"], m3u_dict["tvg-logo"])
+
+
 def dicts_to_m3u(m3u_dicts: list[dict], epg: str | None = None) -> str:
     epg: str = (
         epg
@@ -212,15 +357,51 @@ def channels_to_m3u(
 ) -> str:
     lives: list[dict] = []
 
-    if channels:
-        for channel in channels:
-            lives.extend(get_live_streams(channel))
+    with YoutubeDLPool() as pool, ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        # List every channel first, so videos that appear on several channels
+        # or in the links are only extracted once
+        video_statuses: dict[str, str] = {}
+        for channel_video_urls in ex.map(
+            lambda channel: get_channel_video_urls(channel, pool), channels or []
+        ):
+            for video_url, status in channel_video_urls.items():
+                video_statuses.setdefault(video_url, status)
+        for link in links or []:
+            video_statuses.setdefault(link, "unknown")
+
+        unique_videos: dict[str, tuple[str, str]] = {}
+        for video_url, status in video_statuses.items():
+            video_id = get_video_id(video_url) or video_url
+            unique_videos.setdefault(video_id, (video_url, status))
+
+        # Reuse resolved URLs that aren't about to expire
+        cache = load_youtube_cache()
+        video_urls: list[str] = []
+        for video_id, (video_url, status) in unique_videos.items():
+            max_age = None if status == "live" else UNCONFIRMED_MAX_AGE
+            entry = get_cached_entry(cache, video_id, max_age)
+            if entry is not None:
+                lives.append(entry["metadata"])
+            else:
+                video_urls.append(video_url)
+        print(
+            f"Using {len(unique_videos) - len(video_urls)} cached YouTube URLs, "
+            f"extracting {len(video_urls)} videos"
+        )
+        metrics.increment("youtube_cache_hits", len(unique_videos) - len(video_urls))
+
+        for video_lives in ex.map(
+            lambda video_url: get_live_from_url(video_url, pool), video_urls
+        ):
+            for live in video_lives:
+                lives.append(live)
+                if live.get("id") and live.get("direct_url"):
+                    cache[live["id"]] = make_cache_entry(live["direct_url"], live)
 
-    if links:
-        for link in links:
-            lives.extend(get_live_from_url(link))
+        save_youtube_cache(cache)
 
     m3u_dicts: list[dict] = lives_to_m3u_dict(lives)
+    mirror_thumbnails(m3u_dicts)
     m3u: str = dicts_to_m3u(m3u_dicts)
 
     return m3u
@@ -242,9 +423,7 @@ LINKS: list[str] = [
 def main() -> None:
     start: float = time.perf_counter()
     m3u: str = channels_to_m3u(CHANNELS, LINKS)
-    os.makedirs("output/playlists", exist_ok=True)
-    with open("./output/playlists/playlist_youtube.m3u", "w", encoding="utf-8") as f:
-        f.write(m3u)
+    write_output("output/playlists/playlist_youtube.m3u", m3u)
 
     end: float = time.perf_counter()
     m, s = divmod(end - start, 60)
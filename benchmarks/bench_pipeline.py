@@ -0,0 +1,272 @@
+"""
+Benchmarks for the playlist pipeline's hot paths, run against synthetic
+channel databases so they work offline (no network, no ffprobe).
+
+Usage:
+    python -m benchmarks.bench_pipeline [--sizes 1000 10000 100000] [--repeat 3]
+
+Results are written as JSON so runs can be compared.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from typing import Any, Callable
+
+from channel_store import ChannelStore
+from check_streams import get_best_stream
+from epg_generator import create_epg_from_m3u
+from iptv_playlists import (
+    generate_full_iptv_playlist,
+    generate_iptv_playlists,
+    sort_channels,
+)
+from m3u_utils import generate_playlist, parse_playlist
+
+RESULTS_DIR: str = "benchmarks/results"
+
+GROUPS: list[str] = ["Local", "News", "Sports", "Movies", "Kids", "Music", "TV"]
+WORDS: list[str] = ["ABC", "CBS", "ESPN", "Fox", "HBO", "NBC", "TNT", "USA", "BBC"]
+
+
+def make_database(size: int, seed: int = 0) -> list[dict]:
+    """
+    Builds a synthetic iptv_database.json with `size` channels.
+    """
+    rng = random.Random(seed)
+    database = []
+    for i in range(size):
+        name = f"{rng.choice(WORDS)} {rng.randint(1, 200)} {i}"
+        hosts = [f"cdn{rng.randint(1, 50)}.example.com" for _ in range(3)]
+        database.append(
+            {
+                "tvg-id": f"Channel.{i}.us2",
+                "tvg-name": name,
+                "tvg-logo": f"https://logos.example.com/{i}.png",
+                "group-title": rng.choice(GROUPS),
+                "name": name,
+                "url": f"http://{hosts[0]}/live/{i}/index.m3u8",
+                "commented_urls": [
+                    f"# http://{host}/live/{i}/index.m3u8"
+                    for host in hosts[1 : rng.randint(1, 3)]
+                ],
+            }
+        )
+    return database
+
+
+def make_database_info(database: list[dict], seed: int = 0) -> list[dict]:
+    rng = random.Random(seed)
+    database_info = []
+    for channel in database:
+        working = rng.random() < 0.3
+        database_info.append(
+            {
+                **channel,
+                "width": 1920 if working else 0,
+                "height": 1080 if working else 0,
+                "fps": 30.0 if working else 0,
+                "codec": "h264" if working else "unknown",
+                "bitrate": None,
+                "working": working,
+            }
+        )
+    return database_info
+
+
+def make_playlists_config(
+    database: list[dict], playlists: int = 24, ids: int = 100, seed: int = 0
+) -> dict:
+    rng = random.Random(seed)
+    channel_ids = [channel["tvg-id"] for channel in database]
+    ids = min(ids, len(channel_ids))
+    return {
+        "playlists": {
+            f"playlist_{i}": {"ids": rng.sample(channel_ids, ids)}
+            for i in range(playlists)
+        }
+    }
+
+
+def make_ffprobe_outputs(size: int, seed: int = 0) -> list[dict]:
+    """
+    Builds canned ffprobe JSON outputs: a few video variants and an audio
+    stream per probe.
+    """
+    rng = random.Random(seed)
+    outputs = []
+    for _ in range(size):
+        streams = [
+            {
+                "codec_name": "h264",
+                "width": width,
+                "height": height,
+                "avg_frame_rate": rng.choice(["30/1", "60000/1001", "0/0"]),
+            }
+            for width, height in rng.sample(
+                [(640, 360), (1280, 720), (1920, 1080)], rng.randint(1, 3)
+            )
+        ]
+        streams.append({"codec_name": "aac", "bit_rate": "128000"})
+        outputs.append({"streams": streams, "format": {"bit_rate": "3000000"}})
+    return outputs
+
+
+def measure(func: Callable[[], Any], repeat: int) -> dict[str, float]:
+    """
+    Times `func` (best of `repeat` runs), then runs it once more under
+    tracemalloc to measure its peak memory.
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "best_s": round(min(timings), 6),
+        "mean_s": round(sum(timings) / len(timings), 6),
+        "peak_memory_bytes": peak,
+    }
+
+
+def get_benchmarks(size: int, workdir: str) -> dict[str, tuple[Callable[[], Any], int]]:
+    """
+    Returns the benchmarks for a database size, each with the largest size it
+    is run at (the EPG holds one programme per channel per hour, so it is
+    capped lower).
+    """
+    database = make_database(size)
+    m3u_content = generate_playlist(database)
+    ffprobe_outputs = make_ffprobe_outputs(size)
+
+    with open(os.path.join(workdir, "playlists.yaml"), "w", encoding="utf-8") as f:
+        json.dump(make_playlists_config(database), f)  # JSON is valid YAML
+
+    # The store is created from the JSON files, like on a first run
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir)
+    database_path = os.path.join(data_dir, "iptv_database.json")
+    database_info_path = os.path.join(data_dir, "iptv_database_info.json")
+    with open(database_path, "w", encoding="utf-8") as f:
+        json.dump(database, f, indent=2)
+    with open(database_info_path, "w", encoding="utf-8") as f:
+        json.dump(make_database_info(database), f, indent=2)
+    store = ChannelStore.open(
+        os.path.join(data_dir, "channels.db"), database_path, database_info_path
+    )
+
+    return {
+        "m3u_utils.parse_playlist": (lambda: parse_playlist(m3u_content), 100_000),
+        "m3u_utils.generate_playlist": (lambda: generate_playlist(database), 100_000),
+        "iptv_playlists.sort_channels": (lambda: sort_channels(database), 100_000),
+        "channel_store.ChannelStore.channels": (
+            lambda: store.channels("info", working=True),
+            100_000,
+        ),
+        "channel_store.ChannelStore.export_json": (store.export_json, 100_000),
+        "iptv_playlists.generate_iptv_playlists": (
+            lambda: generate_iptv_playlists(store),
+            100_000,
+        ),
+        "iptv_playlists.generate_full_iptv_playlist": (
+            lambda: generate_full_iptv_playlist(store),
+            100_000,
+        ),
+        "epg_generator.create_epg_from_m3u": (
+            lambda: create_epg_from_m3u(m3u_content),
+            10_000,
+        ),
+        "check_streams.get_best_stream": (
+            lambda: [get_best_stream(output) for output in ffprobe_outputs],
+            100_000,
+        ),
+    }
+
+
+def get_commit() -> str | None:
+    try:
+        p = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return p.stdout.strip()
+
+
+def run_benchmarks(sizes: list[int], repeat: int) -> dict:
+    results: dict[str, Any] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "benchmarks": [],
+    }
+
+    cwd = os.getcwd()
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as workdir:
+            os.makedirs(os.path.join(workdir, "output", "playlists"))
+            # The generators write to output/ relative to the working directory
+            os.chdir(workdir)
+            try:
+                benchmarks = get_benchmarks(size, workdir)
+                for name, (func, max_size) in benchmarks.items():
+                    if size > max_size:
+                        continue
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result = measure(func, repeat)
+                    result = {"name": name, "size": size, **result}
+                    results["benchmarks"].append(result)
+                    print(
+                        f"{name:<44} {size:>7}  {result['best_s']:>9.4f}s  "
+                        f"{result['peak_memory_bytes'] / 2**20:>8.1f} MiB",
+                        file=sys.stderr,
+                    )
+            finally:
+                os.chdir(cwd)
+
+    return results
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(description="Benchmark the playlist pipeline.")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000]
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--output", help=f"results file (default: a timestamped file in {RESULTS_DIR})"
+    )
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, args.repeat)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(RESULTS_DIR, f"bench-{stamp}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
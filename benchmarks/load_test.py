@@ -0,0 +1,344 @@
+"""
+Load test for the stream checker, run against a simulated HLS origin on
+loopback addresses instead of real IPTV hosts.
+
+The origin serves every host as 127.0.0.<n>. Each stream path picks its
+behaviour: healthy, slow, hang, 404 or flapping (alternately up and down).
+Whole hosts can also be made to hang, to exercise the per-host circuit
+breaker.
+
+Usage:
+    python -m benchmarks.load_test [--sizes 1000 10000] [--hosts 20]
+        [--profile healthy=0.8,slow=0.05,hang=0.02,404=0.1,flapping=0.03]
+
+Reports throughput, probe latency percentiles, peak memory and the peak
+number of open files and child processes (ffprobe) of the checker. Linux
+only, since the open files and processes are read from /proc.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+import metrics
+from benchmarks.bench_pipeline import RESULTS_DIR, get_commit
+from channel_store import ChannelStore
+from check_streams import MAX_PER_HOST, MAX_WORKERS, process_channels
+
+BEHAVIOURS: tuple[str, ...] = ("healthy", "slow", "hang", "404", "flapping")
+DEFAULT_PROFILE: str = "healthy=0.8,slow=0.05,hang=0.02,404=0.1,flapping=0.03"
+SLOW_DELAY: float = 2.0
+# Longer than any probe timeout, so hanging requests are always abandoned
+HANG_DELAY: float = 120.0
+SEGMENT_BYTES: int = 256 * 1024
+
+MASTER_PLAYLIST: bytes = (
+    b"#EXTM3U\n"
+    b"#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,FRAME-RATE=30\n"
+    b"low.m3u8\n"
+    b"#EXT-X-STREAM-INF:BANDWIDTH=3000000,RESOLUTION=1280x720,FRAME-RATE=30\n"
+    b"high.m3u8\n"
+)
+MEDIA_PLAYLIST: bytes = (
+    b"#EXTM3U\n#EXT-X-TARGETDURATION:6\n#EXT-X-MEDIA-SEQUENCE:0\n"
+    + b"".join(b"#EXTINF:6.0,\nsegment%d.ts\n" % i for i in range(5))
+)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    """
+    Serves /<behaviour>/<stream>/<file>. The server's `dead` flag makes every
+    request hang.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self) -> None:
+        behaviour, _, rest = self.path.strip("/").partition("/")
+        if self.server.dead or behaviour == "hang":
+            time.sleep(HANG_DELAY)
+            return
+        if behaviour == "404":
+            self.send_error(404)
+            return
+        if behaviour == "slow":
+            time.sleep(SLOW_DELAY)
+        if behaviour == "flapping":
+            with self.server.lock:
+                count = self.server.requests.get(rest, 0)
+                self.server.requests[rest] = count + 1
+            if count % 2:
+                self.send_error(503)
+                return
+
+        if rest.endswith("index.m3u8"):
+            self.send_body(MASTER_PLAYLIST, "application/vnd.apple.mpegurl")
+        elif rest.endswith(".m3u8"):
+            self.send_body(MEDIA_PLAYLIST, "application/vnd.apple.mpegurl")
+        elif rest.endswith(".ts"):
+            self.send_body(b"\x47" * SEGMENT_BYTES, "video/mp2t")
+        else:
+            self.send_error(404)
+
+    def send_body(self, body: bytes, content_type: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+def run_origin(hosts: list[str], dead_hosts: set[str], ready) -> None:
+    """
+    Runs one origin server per host until the process is terminated, and
+    sends their ports through `ready`.
+    """
+    servers = []
+    for host in hosts:
+        server = ThreadingHTTPServer((host, 0), OriginHandler)
+        server.dead = host in dead_hosts
+        server.lock = threading.Lock()
+        server.requests = {}
+        servers.append(server)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    ready.put([server.server_address[1] for server in servers])
+    threading.Event().wait()
+
+
+def parse_profile(profile: str) -> dict[str, float]:
+    weights: dict[str, float] = {}
+    for part in profile.split(","):
+        behaviour, _, weight = part.partition("=")
+        if behaviour not in BEHAVIOURS:
+            raise ValueError(f"unknown behaviour '{behaviour}'")
+        weights[behaviour] = float(weight)
+    return weights
+
+
+def make_load_database(
+    size: int, origins: list[str], weights: dict[str, float], seed: int = 0
+) -> list[dict]:
+    """
+    Builds an iptv_database.json with `size` channels spread over the origins
+    (base URLs), each stream with a behaviour drawn from `weights`.
+    """
+    rng = random.Random(seed)
+    behaviours = list(weights)
+    database = []
+    for i in range(size):
+        origin = origins[i % len(origins)]
+        behaviour = rng.choices(behaviours, [weights[b] for b in behaviours])[0]
+        database.append(
+            {
+                "tvg-id": f"load.{i}.us",
+                "tvg-name": f"Load {i}",
+                "tvg-logo": "",
+                "group-title": "Load",
+                "name": f"Load {i}",
+                "url": f"{origin}/{behaviour}/{i}/index.m3u8",
+                "commented_urls": [],
+            }
+        )
+    return database
+
+
+def count_open_files() -> int:
+    return len(os.listdir("/proc/self/fd"))
+
+
+def count_child_processes(exclude: set[int]) -> int:
+    """
+    Counts the processes whose parent is this process (e.g. ffprobe).
+    """
+    pid = str(os.getpid())
+    count = 0
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit() or int(entry) in exclude:
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # The command name is in parentheses and may contain spaces
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if fields[1] == pid:
+            count += 1
+    return count
+
+
+class ResourceSampler:
+    """
+    Samples the open files and child processes in the background and keeps
+    their peaks.
+    """
+
+    def __init__(self, exclude: set[int], interval: float = 0.1) -> None:
+        self.exclude = exclude
+        self.interval = interval
+        self.peak_open_files = 0
+        self.peak_child_processes = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            self.peak_open_files = max(self.peak_open_files, count_open_files())
+            self.peak_child_processes = max(
+                self.peak_child_processes, count_child_processes(self.exclude)
+            )
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "ResourceSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def run_load_test(
+    database: list[dict],
+    workdir: str,
+    exclude: set[int],
+    max_workers: int,
+    per_host: int,
+) -> dict[str, Any]:
+    """
+    Runs a full check of `database` in `workdir` and measures it.
+    """
+    data_dir = os.path.join(workdir, "data")
+    os.makedirs(data_dir)
+    os.makedirs(os.path.join(workdir, "output"))
+    database_path = os.path.join(data_dir, "iptv_database.json")
+    with open(database_path, "w", encoding="utf-8") as f:
+        json.dump(database, f, indent=2)
+
+    metrics.reset()
+    cwd = os.getcwd()
+    # process_channels writes its manifest to output/ in the working directory
+    os.chdir(workdir)
+    try:
+        with ChannelStore.open(
+            os.path.join(data_dir, "channels.db"),
+            database_path,
+            os.path.join(data_dir, "iptv_database_info.json"),
+        ) as store, ResourceSampler(exclude) as sampler:
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                process_channels(
+                    store, max_workers=max_workers, per_host=per_host, full=True
+                )
+            elapsed = time.perf_counter() - start
+    finally:
+        os.chdir(cwd)
+
+    report = metrics.build_report()
+    counters = report["counters"]
+    probe_latency = report["latencies"].get("probe", {}).get("overall", {})
+    return {
+        "size": len(database),
+        "elapsed_s": round(elapsed, 3),
+        "probes_per_s": round(counters.get("streams_probed", 0) / elapsed, 2),
+        "probe_latency": probe_latency,
+        "channels_working": counters.get("channels_working", 0),
+        "channels_failed": counters.get("channels_failed", 0),
+        "probes_skipped_host_down": counters.get("probes_skipped_host_down", 0),
+        "counters": counters,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        "peak_open_files": sampler.peak_open_files,
+        "peak_child_processes": sampler.peak_child_processes,
+    }
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Load-test the stream checker against a simulated HLS origin."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000])
+    parser.add_argument("--hosts", type=int, default=20, help="simulated hosts")
+    parser.add_argument(
+        "--dead-hosts", type=int, default=1, help="hosts where every request hangs"
+    )
+    parser.add_argument("--profile", default=DEFAULT_PROFILE)
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--per-host", type=int, default=MAX_PER_HOST)
+    parser.add_argument(
+        "--output", help=f"results file (default: a timestamped file in {RESULTS_DIR})"
+    )
+    args = parser.parse_args(argv)
+    try:
+        weights = parse_profile(args.profile)
+    except ValueError as e:
+        parser.error(str(e))
+
+    hosts = [f"127.0.0.{i + 1}" for i in range(args.hosts)]
+    dead_hosts = set(hosts[len(hosts) - args.dead_hosts :] if args.dead_hosts else [])
+    ready = multiprocessing.Queue()
+    origin = multiprocessing.Process(
+        target=run_origin, args=(hosts, dead_hosts, ready), daemon=True
+    )
+    origin.start()
+    ports = ready.get(timeout=30)
+    origins = [f"http://{host}:{port}" for host, port in zip(hosts, ports)]
+
+    results: dict[str, Any] = {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": get_commit(),
+        "hosts": args.hosts,
+        "dead_hosts": args.dead_hosts,
+        "profile": weights,
+        "workers": args.workers,
+        "per_host": args.per_host,
+        "runs": [],
+    }
+    try:
+        for size in args.sizes:
+            database = make_load_database(size, origins, weights)
+            with tempfile.TemporaryDirectory() as workdir:
+                run = run_load_test(
+                    database, workdir, {origin.pid}, args.workers, args.per_host
+                )
+            results["runs"].append(run)
+            latency = run["probe_latency"]
+            print(
+                f"{size:>7} channels  {run['elapsed_s']:>8.2f}s  "
+                f"{run['probes_per_s']:>8.2f} probes/s  "
+                f"p50 {latency.get('p50', 0):.3f}s  p95 {latency.get('p95', 0):.3f}s  "
+                f"max {latency.get('max', 0):.3f}s  "
+                f"{run['peak_rss_bytes'] / 2**20:.0f} MiB  "
+                f"{run['peak_open_files']} fds  "
+                f"{run['peak_child_processes']} procs",
+                file=sys.stderr,
+            )
+    finally:
+        origin.terminate()
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+        output = os.path.join(RESULTS_DIR, f"load-{stamp}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,627 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+from typing import Any, Iterable, Iterator
+from urllib.parse import urlsplit
+from urllib.request import pathname2url
+
+from output_utils import write_output
+
+STORE_PATH: str = "data/channels.db"
+# Exports of the store. iptv_database.json is also read back in when it has
+# been edited by hand since the last export.
+DATABASE_PATH: str = "data/iptv_database.json"
+DATABASE_INFO_PATH: str = "data/iptv_database_info.json"
+
+SCHEMA: str = """
+CREATE TABLE IF NOT EXISTS channels (
+    position INTEGER PRIMARY KEY,
+    tvg_id TEXT,
+    tvg_name TEXT,
+    tvg_logo TEXT,
+    group_title TEXT,
+    name TEXT,
+    url TEXT,
+    host TEXT,
+    commented_urls TEXT NOT NULL DEFAULT '[]',
+    -- Derived from the probes of the channel's URLs by refresh_status()
+    best_url TEXT,
+    working INTEGER NOT NULL DEFAULT 0,
+    width INTEGER,
+    height INTEGER,
+    fps REAL,
+    codec TEXT,
+    bitrate INTEGER,
+    sources TEXT,
+    quality TEXT
+);
+CREATE INDEX IF NOT EXISTS channels_tvg_id ON channels (tvg_id);
+CREATE INDEX IF NOT EXISTS channels_group_title ON channels (group_title);
+CREATE INDEX IF NOT EXISTS channels_host ON channels (host);
+CREATE INDEX IF NOT EXISTS channels_working ON channels (working);
+
+CREATE TABLE IF NOT EXISTS probes (
+    url TEXT PRIMARY KEY,
+    host TEXT,
+    result TEXT,
+    latency REAL,
+    checked REAL NOT NULL DEFAULT 0,
+    failures INTEGER NOT NULL DEFAULT 0,
+    -- Why the last probe failed, e.g. "timeout" or "host_down"
+    reason TEXT,
+    -- JSON list of the latencies of the last successful probes
+    latencies TEXT,
+    -- JSON measurements of the last deep check (see stream_sampler.py)
+    quality TEXT
+);
+CREATE INDEX IF NOT EXISTS probes_host ON probes (host);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Columns added after a table was first created, so older stores are upgraded
+ADDED_COLUMNS: dict[str, dict[str, str]] = {
+    "channels": {"quality": "TEXT"},
+    "probes": {"reason": "TEXT", "latencies": "TEXT", "quality": "TEXT"},
+}
+
+# JSON keys of a channel and the Channel attributes they map to
+CHANNEL_KEYS: dict[str, str] = {
+    "tvg-id": "tvg_id",
+    "tvg-name": "tvg_name",
+    "tvg-logo": "tvg_logo",
+    "group-title": "group_title",
+    "name": "name",
+    "url": "url",
+    "commented_urls": "commented_urls",
+}
+STREAM_KEYS: tuple[str, ...] = ("width", "height", "fps", "codec", "bitrate")
+
+# What a deep-checked stream needs to count as reliable: it downloads well
+# ahead of real time, starts quickly and had no failed segments
+RELIABLE_THROUGHPUT_RATIO: float = 1.5
+RELIABLE_TIME_TO_FIRST_SEGMENT: float = 5.0
+HD_MIN_HEIGHT: int = 720
+
+
+def get_host(url: str) -> str:
+    try:
+        return (urlsplit(url).hostname or "").lower()
+    except ValueError:  # e.g. an unterminated IPv6 address
+        return ""
+
+
+def get_candidate_urls(channel) -> list[str]:
+    """
+    Returns the channel's active URL followed by its commented-out fallbacks.
+    """
+    urls: list[str] = [channel["url"]]
+    for commented_url in channel.get("commented_urls") or []:
+        url = re.sub(r"^#\s*", "", commented_url.strip())
+        if "://" in url and url not in urls:
+            urls.append(url)
+    return urls
+
+
+def get_source_info(url: str, entry: dict[str, Any] | None) -> dict[str, Any]:
+    main_stream: dict | None = entry["result"] if entry else None
+    source: dict[str, Any] = {
+        "url": url,
+        "working": main_stream is not None,
+        "latency": entry.get("latency") if entry else None,
+    }
+    if entry and main_stream is None and entry.get("reason"):
+        source["reason"] = entry["reason"]
+    if main_stream is not None:
+        source["width"] = main_stream.get("width", 0)
+        source["height"] = main_stream.get("height", 0)
+        source["fps"] = main_stream.get("fps", 0)
+        if entry.get("quality"):
+            source["quality"] = entry["quality"]
+    return source
+
+
+def is_reliable(quality: dict[str, Any] | None) -> bool:
+    """
+    Tells whether a stream's deep-check measurements show it can be watched
+    without buffering.
+    """
+    if not quality or quality.get("error") or quality.get("segment_errors"):
+        return False
+    ratio: float | None = quality.get("throughput_ratio")
+    startup: float | None = quality.get("time_to_first_segment")
+    return (
+        ratio is not None
+        and ratio >= RELIABLE_THROUGHPUT_RATIO
+        and startup is not None
+        and startup <= RELIABLE_TIME_TO_FIRST_SEGMENT
+    )
+
+
+def rank_source(source: dict[str, Any]) -> tuple[int, float, bool, float]:
+    """
+    Sort key for working sources: resolution, then frame rate, then whether
+    the deep check found it reliable, then the fastest response.
+    """
+    latency: float | None = source.get("latency")
+    return (
+        source.get("height", 0),
+        source.get("fps", 0),
+        is_reliable(source.get("quality")),
+        -latency if latency is not None else float("-inf"),
+    )
+
+
+def get_channel_status(channel, probes: dict[str, dict[str, Any]]) -> dict[str, Any]:
+    """
+    Works out a channel's status from the probes of its candidate URLs. The
+    best working source, if any, becomes the channel's active URL.
+    """
+    sources: list[dict[str, Any]] = [
+        get_source_info(url, probes.get(url)) for url in get_candidate_urls(channel)
+    ]
+    status: dict[str, Any] = {"sources": sources, "best_url": None, "working": False}
+
+    working_sources = [source for source in sources if source["working"]]
+    if working_sources:
+        best_url: str = max(working_sources, key=rank_source)["url"]
+        main_stream: dict = probes[best_url]["result"]
+        status.update(
+            best_url=best_url,
+            working=True,
+            width=main_stream.get("width", 0),
+            height=main_stream.get("height", 0),
+            fps=main_stream.get("fps", 0),
+            codec=main_stream.get("codec", "unknown"),
+            bitrate=main_stream.get("bitrate", 0),
+            quality=probes[best_url].get("quality"),
+        )
+    return status
+
+
+INSERT_PROBE: str = (
+    "INSERT OR REPLACE INTO probes (url, host, result, latency, checked, failures,"
+    " reason, latencies, quality) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+)
+
+
+def get_probe_row(url: str, entry: dict[str, Any]) -> tuple:
+    return (
+        url,
+        get_host(url),
+        json.dumps(entry["result"]) if entry["result"] is not None else None,
+        entry.get("latency"),
+        entry.get("checked", 0),
+        entry.get("failures", 0),
+        entry.get("reason"),
+        json.dumps(entry.get("latencies") or []),
+        json.dumps(entry["quality"]) if entry.get("quality") else None,
+    )
+
+
+class Channel:
+    """
+    A channel loaded from the store. Supports the dict-style access used by
+    the playlist generators (`channel["tvg-id"]`, `channel.get("url")`).
+    """
+
+    __slots__ = (
+        "position",
+        "tvg_id",
+        "tvg_name",
+        "tvg_logo",
+        "group_title",
+        "name",
+        "url",
+        "commented_urls",
+        "working",
+        "width",
+        "height",
+        "fps",
+        "codec",
+        "bitrate",
+        "sources",
+        "quality",
+    )
+
+    def __init__(self, **fields: Any) -> None:
+        for slot in self.__slots__:
+            setattr(self, slot, fields.get(slot))
+
+    def get(self, key: str, default: Any = None) -> Any:
+        attribute = CHANNEL_KEYS.get(key, key)
+        if attribute not in self.__slots__:
+            return default
+        value = getattr(self, attribute)
+        return default if value is None else value
+
+    def __getitem__(self, key: str) -> Any:
+        attribute = CHANNEL_KEYS.get(key, key)
+        if attribute not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, attribute)
+
+    def __contains__(self, key: str) -> bool:
+        return CHANNEL_KEYS.get(key, key) in self.__slots__
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(CHANNEL_KEYS)
+
+    def to_dict(self, info: bool = False) -> dict[str, Any]:
+        """
+        Returns the channel as an iptv_database.json record, or as an
+        iptv_database_info.json record (with stream info) if `info` is set.
+        """
+        data: dict[str, Any] = {
+            key: getattr(self, attribute) for key, attribute in CHANNEL_KEYS.items()
+        }
+        data["commented_urls"] = list(self.commented_urls or [])
+        if info:
+            for key in STREAM_KEYS:
+                if getattr(self, key) is not None:
+                    data[key] = getattr(self, key)
+            data["working"] = bool(self.working)
+            if self.quality is not None:
+                data["quality"] = self.quality
+            data["sources"] = self.sources or []
+        return data
+
+
+class ChannelStore:
+    """
+    SQLite store holding the channel database and the probe results of every
+    stream URL. Open it with `ChannelStore.open()`.
+    """
+
+    def __init__(
+        self,
+        connection: sqlite3.Connection,
+        database_path: str = DATABASE_PATH,
+        database_info_path: str = DATABASE_INFO_PATH,
+    ) -> None:
+        self.connection = connection
+        self.connection.row_factory = sqlite3.Row
+        self.database_path = database_path
+        self.database_info_path = database_info_path
+
+    @classmethod
+    def open(
+        cls,
+        path: str = STORE_PATH,
+        database_path: str = DATABASE_PATH,
+        database_info_path: str = DATABASE_INFO_PATH,
+    ) -> "ChannelStore":
+        """
+        Opens the store, creating it from the JSON files on first use. If
+        `database_path` was edited since the store last exported it, the
+        channels are imported from it again.
+        """
+        is_new = not os.path.exists(path)
+        store = cls(sqlite3.connect(path), database_path, database_info_path)
+        store.connection.executescript(SCHEMA)
+        store.upgrade_schema()
+
+        if is_new and os.path.exists(database_info_path):
+            with open(database_info_path, "r", encoding="utf-8") as f:
+                store.seed_probes(json.load(f))
+
+        if os.path.exists(database_path):
+            with open(database_path, "rb") as f:
+                content = f.read()
+            digest = hashlib.sha256(content).hexdigest()
+            if store.get_meta("database_sha256") != digest:
+                print(f"Importing channels from {database_path}")
+                store.import_channels(json.loads(content))
+                store.set_meta("database_sha256", digest)
+        return store
+
+    @classmethod
+    def open_readonly(cls, path: str = STORE_PATH) -> "ChannelStore":
+        """
+        Opens an existing store for reading only, without creating it or
+        importing the JSON files.
+        """
+        uri = f"file:{pathname2url(os.path.abspath(path))}?mode=ro"
+        return cls(sqlite3.connect(uri, uri=True))
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "ChannelStore":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def upgrade_schema(self) -> None:
+        """
+        Adds the columns in ADDED_COLUMNS to stores created before them.
+        """
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {
+                row["name"]
+                for row in self.connection.execute(f"PRAGMA table_info({table})")
+            }
+            with self.connection:
+                for column, definition in columns.items():
+                    if column not in existing:
+                        self.connection.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                        )
+
+    def get_meta(self, key: str) -> str | None:
+        row = self.connection.execute(
+            "SELECT value FROM meta WHERE key = ?", (key,)
+        ).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+            )
+
+    def get_data_version(self) -> int:
+        """
+        Returns a counter that changes whenever the channels or their status
+        do, but not on every saved probe.
+        """
+        return int(self.get_meta("data_version") or 0)
+
+    def bump_data_version(self) -> None:
+        self.set_meta("data_version", str(self.get_data_version() + 1))
+
+    def import_channels(self, channels: Iterable[dict]) -> None:
+        """
+        Replaces the channels with those of an iptv_database.json list, then
+        derives their status from the stored probes.
+        """
+        rows = [
+            (
+                position,
+                channel.get("tvg-id"),
+                channel.get("tvg-name"),
+                channel.get("tvg-logo"),
+                channel.get("group-title"),
+                channel.get("name"),
+                channel.get("url"),
+                get_host(channel.get("url") or ""),
+                json.dumps(channel.get("commented_urls") or []),
+            )
+            for position, channel in enumerate(channels)
+        ]
+        with self.connection:
+            self.connection.execute("DELETE FROM channels")
+            self.connection.executemany(
+                "INSERT INTO channels (position, tvg_id, tvg_name, tvg_logo,"
+                " group_title, name, url, host, commented_urls)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        self.refresh_status()
+        self.bump_data_version()
+
+    def seed_probes(self, database_info: list[dict]) -> None:
+        """
+        Seeds the probes from an iptv_database_info.json list. The seeded
+        entries count as stale, so the next check probes them again.
+        """
+        probes: dict[str, dict[str, Any]] = {}
+        for channel in database_info:
+            if channel.get("working"):
+                result = {key: channel.get(key) for key in STREAM_KEYS}
+                probes[channel["url"]] = {
+                    "result": result,
+                    "latency": None,
+                    "checked": 0,
+                    "failures": 0,
+                }
+        self.save_probes(probes)
+
+    def channels(
+        self,
+        view: str = "database",
+        working: bool | None = None,
+        tvg_ids: Iterable[str] | None = None,
+        group_title: str | None = None,
+        host: str | None = None,
+        min_height: int | None = None,
+        positions: Iterable[int] | None = None,
+    ) -> list[Channel]:
+        """
+        Loads channels in database order, optionally filtered.
+
+        Args:
+            view: "database" for the channels as configured, or "info" for
+                  the channels with their best working source as active URL.
+            working: Only load working (True) or broken (False) channels.
+            tvg_ids: Only load channels with these tvg-ids.
+            group_title: Only load channels of this group.
+            host: Only load channels whose configured URL is on this host.
+            min_height: Only load channels with at least this resolution.
+            positions: Only load the channels at these positions.
+
+        Returns:
+            The matching channels.
+        """
+        clauses: list[str] = []
+        params: list[Any] = []
+        if working is not None:
+            clauses.append("working = ?")
+            params.append(int(working))
+        if tvg_ids is not None:
+            clauses.append("tvg_id IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(tvg_ids)))
+        if group_title is not None:
+            clauses.append("group_title = ?")
+            params.append(group_title)
+        if host is not None:
+            clauses.append("host = ?")
+            params.append(host)
+        if min_height is not None:
+            clauses.append("height >= ?")
+            params.append(min_height)
+        if positions is not None:
+            clauses.append("position IN (SELECT value FROM json_each(?))")
+            params.append(json.dumps(list(positions)))
+
+        query = "SELECT * FROM channels"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY position"
+
+        return [
+            self._row_to_channel(row, view)
+            for row in self.connection.execute(query, params)
+        ]
+
+    def tvg_ids(self) -> set[str]:
+        rows = self.connection.execute(
+            "SELECT DISTINCT tvg_id FROM channels WHERE tvg_id IS NOT NULL"
+            " AND tvg_id != ''"
+        )
+        return {row["tvg_id"] for row in rows}
+
+    def _row_to_channel(self, row: sqlite3.Row, view: str) -> Channel:
+        url: str = row["url"]
+        commented_urls: list[str] = json.loads(row["commented_urls"])
+        if view == "info" and row["best_url"]:
+            candidate_urls = get_candidate_urls(
+                {"url": url, "commented_urls": commented_urls}
+            )
+            url = row["best_url"]
+            commented_urls = [f"# {other}" for other in candidate_urls if other != url]
+
+        return Channel(
+            position=row["position"],
+            tvg_id=row["tvg_id"],
+            tvg_name=row["tvg_name"],
+            tvg_logo=row["tvg_logo"],
+            group_title=row["group_title"],
+            name=row["name"],
+            url=url,
+            commented_urls=commented_urls,
+            working=bool(row["working"]),
+            width=row["width"],
+            height=row["height"],
+            fps=row["fps"],
+            codec=row["codec"],
+            bitrate=row["bitrate"],
+            sources=json.loads(row["sources"]) if row["sources"] else [],
+            quality=json.loads(row["quality"]) if row["quality"] else None,
+        )
+
+    def load_probes(self) -> dict[str, dict[str, Any]]:
+        """
+        Returns the probe results, keyed by URL.
+        """
+        return {
+            row["url"]: {
+                "result": json.loads(row["result"]) if row["result"] else None,
+                "latency": row["latency"],
+                "checked": row["checked"],
+                "failures": row["failures"],
+                "reason": row["reason"],
+                "latencies": json.loads(row["latencies"]) if row["latencies"] else [],
+                "quality": json.loads(row["quality"]) if row["quality"] else None,
+            }
+            for row in self.connection.execute("SELECT * FROM probes")
+        }
+
+    def save_probes(self, probes: dict[str, dict[str, Any]]) -> None:
+        """
+        Replaces the probe results. URLs missing from `probes` are dropped.
+        """
+        rows = [get_probe_row(url, entry) for url, entry in probes.items()]
+        with self.connection:
+            self.connection.execute("DELETE FROM probes")
+            self.connection.executemany(INSERT_PROBE, rows)
+
+    def save_probe(self, url: str, entry: dict[str, Any]) -> None:
+        """
+        Saves the probe result of a single URL.
+        """
+        with self.connection:
+            self.connection.execute(INSERT_PROBE, get_probe_row(url, entry))
+
+    def refresh_status(
+        self,
+        probes: dict[str, dict[str, Any]] | None = None,
+        positions: Iterable[int] | None = None,
+    ) -> list[Channel]:
+        """
+        Re-derives the channels' status from the probes. Broken channels keep
+        the stream info of their last working source.
+
+        Args:
+            probes: The probe results. Loaded from the store if not given.
+            positions: Only refresh the channels at these positions.
+
+        Returns:
+            The refreshed channels whose working status flipped.
+        """
+        if probes is None:
+            probes = self.load_probes()
+
+        updates_working = []
+        updates_broken = []
+        flipped: list[Channel] = []
+        for channel in self.channels(positions=positions):
+            status = get_channel_status(channel, probes)
+            if status["working"] != channel.working:
+                flipped.append(channel)
+            sources = json.dumps(status["sources"])
+            if status["working"]:
+                updates_working.append(
+                    (
+                        status["best_url"],
+                        status["width"],
+                        status["height"],
+                        status["fps"],
+                        status["codec"],
+                        status["bitrate"],
+                        sources,
+                        json.dumps(status["quality"]) if status["quality"] else None,
+                        channel.position,
+                    )
+                )
+            else:
+                updates_broken.append((sources, channel.position))
+
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE channels SET working = 1, best_url = ?, width = ?,"
+                " height = ?, fps = ?, codec = ?, bitrate = ?, sources = ?,"
+                " quality = ? WHERE position = ?",
+                updates_working,
+            )
+            self.connection.executemany(
+                "UPDATE channels SET working = 0, best_url = NULL, sources = ?,"
+                " quality = NULL WHERE position = ?",
+                updates_broken,
+            )
+        if flipped:
+            self.bump_data_version()
+        return flipped
+
+    def export_json(self) -> None:
+        """
+        Writes iptv_database.json and iptv_database_info.json from the store.
+        """
+        database = [channel.to_dict() for channel in self.channels()]
+        content = json.dumps(database, indent=2)
+        write_output(self.database_path, content)
+        self.set_meta(
+            "database_sha256", hashlib.sha256(content.encode("utf-8")).hexdigest()
+        )
+
+        database_info = [
+            channel.to_dict(info=True) for channel in self.channels("info")
+        ]
+        write_output(self.database_info_path, json.dumps(database_info, indent=2))
+        self.bump_data_version()
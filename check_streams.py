@@ -1,32 +1,137 @@
+import argparse
 import json
+import re
 import subprocess
-from copy import deepcopy
-from typing import Any
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterator
 
-with open("data/iptv_database_info.json", "r", encoding="utf-8") as f:
-    json_db: list[dict[str, str | list[str]]] = json.load(f)
+import httpx
 
+import metrics
+from channel_store import ChannelStore, get_candidate_urls, get_host
 
-def get_stream_info(url: str) -> dict:
-    # ffprobe
+# Concurrency limits for the probe pool. MAX_PER_HOST keeps a single flaky
+# origin (e.g. fl1.moveonjoy.com) from occupying every worker.
+MAX_WORKERS: int = 16
+MAX_PER_HOST: int = 4
+# Consecutive failures after which a host's remaining URLs are skipped, so a
+# dead CDN costs a few timeouts instead of one per channel
+BREAKER_THRESHOLD: int = 3
+
+# Manifest fetches identify as libavformat so hosts treat them like ffprobe
+HTTP_HEADERS: dict[str, str] = {"User-Agent": "Lavf/60.16.100"}
+HTTP_TIMEOUT: float = 10.0
+MAX_MANIFEST_BYTES: int = 1024 * 1024
+
+# Probe results are kept per URL in the channel store. The intervals sit just
+# under multiples of the 3-hourly cron so scheduling jitter doesn't skip a
+# run: healthy streams are re-checked every other run, dead ones back off
+# exponentially (1h, 2h, 4h, ...) up to once a week.
+HEALTHY_TTL: int = 5 * 3600
+FAILURE_BACKOFF_BASE: int = 3600
+FAILURE_BACKOFF_MAX: int = 7 * 24 * 3600
+
+# Probe timeouts adapt to each URL's history: TIMEOUT_MULTIPLIER times the p95
+# of its last LATENCY_HISTORY successful probes, within these bounds
+MIN_PROBE_TIMEOUT: float = 5.0
+MAX_PROBE_TIMEOUT: float = 30.0
+TIMEOUT_MULTIPLIER: float = 4.0
+LATENCY_HISTORY: int = 10
+
+FAILURE_REASONS: tuple[str, ...] = (
+    "timeout",
+    "dns",
+    "connection_error",
+    "http_4xx",
+    "http_5xx",
+    "no_video",
+    "probe_error",
+    "host_down",
+)
+# Failures that count towards a host's circuit breaker
+HOST_FAILURE_REASONS: frozenset[str] = frozenset(
+    {"timeout", "dns", "connection_error", "http_5xx"}
+)
+DNS_ERROR_PATTERN = re.compile(
+    r"name or service not known|nodename nor servname|name resolution"
+    r"|getaddrinfo failed|no address associated",
+    re.IGNORECASE,
+)
+# ffprobe's error messages (with -v error) and the failure they point at
+FFPROBE_ERRORS: list[tuple[re.Pattern, str]] = [
+    (re.compile(r"timed out", re.IGNORECASE), "timeout"),
+    (re.compile(r"failed to resolve hostname", re.IGNORECASE), "dns"),
+    (re.compile(r"connection refused", re.IGNORECASE), "connection_error"),
+    (re.compile(r"server returned 4\d\d|4XX Client Error", re.IGNORECASE), "http_4xx"),
+    (re.compile(r"server returned 5\d\d|5XX Server Error", re.IGNORECASE), "http_5xx"),
+]
+
+HLS_ATTRIBUTE_PATTERN = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+HLS_CODECS: dict[str, str] = {
+    "avc1": "h264",
+    "avc3": "h264",
+    "hvc1": "hevc",
+    "hev1": "hevc",
+    "av01": "av1",
+    "vp09": "vp9",
+}
+
+
+class ProbeError(Exception):
+    """
+    Raised when a stream can't be probed. `reason` is one of the
+    FAILURE_REASONS.
+    """
+
+    def __init__(self, reason: str, message: str = "") -> None:
+        super().__init__(message or reason)
+        self.reason = reason
+
+
+def classify_ffprobe_error(stderr: str) -> str:
+    for pattern, reason in FFPROBE_ERRORS:
+        if pattern.search(stderr):
+            return reason
+    return "probe_error"
+
+
+def get_stream_info(url: str, timeout: float = MAX_PROBE_TIMEOUT) -> dict:
+    """
+    Runs ffprobe on a URL. Raises ProbeError if ffprobe fails or times out.
+    """
+    metrics.increment("ffprobe_runs")
     try:
-        p = subprocess.run(
-            [
-                "ffprobe",
-                "-v",
-                "quiet",
-                "-print_format",
-                "json",
-                "-show_entries",
-                "stream=width,height,avg_frame_rate,bit_rate,codec_name:format=duration,bit_rate",
-                url,
-            ],
-            stdout=subprocess.PIPE,
-            timeout=30,
-        )
-        return json.loads(p.stdout.decode("utf-8"))
+        with metrics.timed("ffprobe", get_host(url)):
+            p = subprocess.run(
+                [
+                    "ffprobe",
+                    "-v",
+                    "error",
+                    "-print_format",
+                    "json",
+                    "-show_entries",
+                    "stream=width,height,avg_frame_rate,bit_rate,codec_name:format=duration,bit_rate",
+                    url,
+                ],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                timeout=timeout,
+            )
     except subprocess.TimeoutExpired:
-        return {}
+        metrics.increment("ffprobe_timeouts")
+        raise ProbeError("timeout", f"ffprobe timed out after {timeout:.0f}s")
+    except OSError as e:
+        raise ProbeError("probe_error", f"ffprobe could not run: {e}")
+
+    stderr = p.stderr.decode("utf-8", errors="replace")
+    if p.returncode != 0:
+        raise ProbeError(classify_ffprobe_error(stderr), stderr.strip())
+    try:
+        return json.loads(p.stdout.decode("utf-8"))
+    except ValueError:
+        raise ProbeError("probe_error", "ffprobe returned invalid JSON")
 
 
 def get_best_stream(data: dict) -> dict[str, Any] | None:
@@ -77,31 +182,445 @@ def get_best_stream(data: dict) -> dict[str, Any] | None:
     return best_stream
 
 
+def create_http_client(max_workers: int = MAX_WORKERS) -> httpx.Client:
+    return httpx.Client(
+        headers=HTTP_HEADERS,
+        timeout=HTTP_TIMEOUT,
+        follow_redirects=True,
+        limits=httpx.Limits(
+            max_connections=max_workers, max_keepalive_connections=max_workers
+        ),
+    )
+
+
+def fetch_hls_manifest(
+    url: str, client: httpx.Client, timeout: float = HTTP_TIMEOUT
+) -> str | None:
+    """
+    Downloads an HLS playlist. Returns None if the response is not an M3U
+    playlist (e.g. a raw MPEG-TS stream), without reading the rest of the body.
+    Raises httpx.HTTPError if the request fails.
+    """
+    with client.stream("GET", url, timeout=timeout) as response:
+        try:
+            response.raise_for_status()
+            content = b""
+            for chunk in response.iter_bytes():
+                content += chunk
+                head = content.lstrip()
+                if len(head) >= 7 and not head.startswith(b"#EXTM3U"):
+                    return None
+                if len(content) > MAX_MANIFEST_BYTES:
+                    return None
+        finally:
+            metrics.increment("bytes_downloaded", response.num_bytes_downloaded)
+
+    if not content.lstrip().startswith(b"#EXTM3U"):
+        return None
+    return content.decode("utf-8", errors="replace")
+
+
+def iter_manifest_variants(manifest: str) -> Iterator[tuple[dict[str, str], str]]:
+    """
+    Yields the attributes and URI of each variant stream of an HLS master
+    playlist.
+    """
+    attributes: dict[str, str] | None = None
+    for line in manifest.splitlines():
+        line = line.strip()
+        if line.startswith("#EXT-X-STREAM-INF:"):
+            attributes = {
+                key: value.strip('"')
+                for key, value in HLS_ATTRIBUTE_PATTERN.findall(line.partition(":")[2])
+            }
+        elif attributes is not None and line and not line.startswith("#"):
+            yield attributes, line
+            attributes = None
+
+
+def get_manifest_stream(manifest: str) -> dict[str, Any] | None:
+    """
+    Reads the variant streams of an HLS master playlist and picks the highest
+    quality one, in the same format as `get_best_stream`.
+    Returns None unless a variant declares both RESOLUTION and FRAME-RATE.
+    """
+    candidates = []
+
+    for attributes, _ in iter_manifest_variants(manifest):
+        try:
+            width, height = map(int, attributes["RESOLUTION"].lower().split("x"))
+            fps = float(attributes["FRAME-RATE"])
+        except (KeyError, ValueError):
+            continue
+
+        codec = "unknown"
+        for codec_tag in attributes.get("CODECS", "").split(","):
+            codec_tag = codec_tag.strip().split(".")[0].lower()
+            if codec_tag in HLS_CODECS:
+                codec = HLS_CODECS[codec_tag]
+                break
+
+        bandwidth = attributes.get("BANDWIDTH", "")
+        candidates.append(
+            {
+                "width": width,
+                "height": height,
+                "fps": round(fps, 2),
+                "codec": codec,
+                "bitrate": int(bandwidth) if bandwidth.isdigit() else None,
+            }
+        )
+
+    if not candidates:
+        return None
+
+    return max(candidates, key=lambda x: (x["height"], x["fps"]))
+
+
+def classify_http_error(error: httpx.HTTPError) -> str:
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.HTTPStatusError):
+        return "http_5xx" if error.response.status_code >= 500 else "http_4xx"
+    if isinstance(error, httpx.ConnectError):
+        if DNS_ERROR_PATTERN.search(str(error)):
+            return "dns"
+        return "connection_error"
+    return "probe_error"
+
+
+def find_best_stream(
+    url: str, client: httpx.Client | None = None, timeout: float = MAX_PROBE_TIMEOUT
+) -> dict:
+    """
+    Finds the best stream of a URL. HLS master playlists are read over HTTP
+    first; ffprobe only runs for other URLs or manifests that don't declare
+    their variants' resolution and frame rate.
+    Raises ProbeError if the URL fails or has no video stream.
+    """
+    if client is not None and url.startswith(("http://", "https://")):
+        try:
+            manifest = fetch_hls_manifest(url, client, min(timeout, HTTP_TIMEOUT))
+        except httpx.HTTPError as e:
+            raise ProbeError(classify_http_error(e), repr(e))
+        except (httpx.InvalidURL, ValueError) as e:
+            raise ProbeError("probe_error", repr(e))
+
+        if manifest is not None:
+            main_stream = get_manifest_stream(manifest)
+            if main_stream is not None:
+                return main_stream
+
+    main_stream = get_best_stream(get_stream_info(url, timeout))
+    if main_stream is None:
+        raise ProbeError("no_video")
+    return main_stream
+
+
+def get_probe_timeout(entry: dict[str, Any] | None) -> float:
+    """
+    Derives a URL's probe timeout from the latencies of its past successful
+    probes: TIMEOUT_MULTIPLIER times their p95, clamped between
+    MIN_PROBE_TIMEOUT and MAX_PROBE_TIMEOUT. URLs without a history get the
+    maximum.
+    """
+    latencies: list[float] = (entry or {}).get("latencies") or []
+    if not latencies:
+        return MAX_PROBE_TIMEOUT
+    timeout = TIMEOUT_MULTIPLIER * metrics.percentile(latencies, 95)
+    return min(max(timeout, MIN_PROBE_TIMEOUT), MAX_PROBE_TIMEOUT)
+
+
+def probe_url(
+    url: str, client: httpx.Client | None = None, timeout: float = MAX_PROBE_TIMEOUT
+) -> dict[str, Any]:
+    """
+    Probes a URL and times it. `latency` is the time taken to fetch the
+    manifest (or to run ffprobe), in seconds, and `reason` says why the probe
+    failed (None if it succeeded).
+    """
+    start: float = time.perf_counter()
+    main_stream: dict | None = None
+    reason: str | None = None
+    try:
+        main_stream = find_best_stream(url, client, timeout)
+    except ProbeError as e:
+        reason = e.reason
+        metrics.increment(f"probe_failures_{reason}")
+    end: float = time.perf_counter()
+    metrics.record_latency("probe", end - start, get_host(url))
+    return {"stream": main_stream, "latency": round(end - start, 3), "reason": reason}
+
+
+def is_host_failure(result: dict[str, Any]) -> bool:
+    """
+    Tells whether a probe failed in a way that suggests its host is down.
+    A 404 or a stream without video still means the host answered.
+    """
+    return result.get("reason") in HOST_FAILURE_REASONS
+
+
+def host_down_result(url: str) -> dict[str, Any]:
+    """
+    The result recorded for URLs skipped because their host's circuit breaker
+    tripped.
+    """
+    return {"stream": None, "latency": None, "reason": "host_down"}
+
+
+def probe_error_result(url: str, error: Exception) -> dict[str, Any]:
+    """
+    The result recorded for URLs whose probe raised an unexpected exception.
+    """
+    return {"stream": None, "latency": None, "reason": "probe_error"}
+
+
+def report_host_down(host: str, skipped: list[str]) -> None:
+    """
+    Reports a host whose circuit breaker tripped during the stream check.
+    """
+    print(f"{host} looks down, skipping {len(skipped)} streams")
+    metrics.increment("hosts_down")
+    metrics.increment("probes_skipped_host_down", len(skipped))
+
+
+def run_probes(
+    urls: list[str],
+    probe: Callable[[str], Any] = probe_url,
+    max_workers: int = MAX_WORKERS,
+    per_host: int = MAX_PER_HOST,
+    breaker_threshold: int = BREAKER_THRESHOLD,
+    is_failure: Callable[[Any], bool] = is_host_failure,
+    host_down: Callable[[str], Any] = host_down_result,
+    probe_error: Callable[[str, Exception], Any] = probe_error_result,
+    on_host_down: Callable[[str, list[str]], Any] = report_host_down,
+) -> dict[str, Any]:
+    """
+    Probes every unique URL on a bounded thread pool.
+
+    URLs are queued per host and handed out round-robin, so no host ever has
+    more than `per_host` probes in flight and a slow host cannot starve the
+    others of workers.
+
+    Each host starts with a single canary probe (its first queued URL). The
+    rest of its URLs are only probed in parallel once a probe on the host
+    succeeds. After `breaker_threshold` consecutive failures on a host, its
+    circuit breaker trips and its remaining URLs are not probed at all.
+
+    Args:
+        urls: The URLs to probe, in order of preference within each host.
+              Duplicates are only probed once.
+        probe: Callable run in a worker thread for each URL.
+        max_workers: Maximum number of probes running at the same time.
+        per_host: Maximum number of probes running against a single host.
+        breaker_threshold: Consecutive failures after which a host is
+                           considered down.
+        is_failure: Tells whether a result of `probe` counts towards the
+                    host's circuit breaker.
+        host_down: Returns the result recorded for a URL skipped because its
+                   host is down.
+        probe_error: Returns the result recorded for a URL whose probe raised
+                     an exception, so one bad URL doesn't abort the run.
+        on_host_down: Called with a host and its skipped URLs when the host's
+                      circuit breaker trips, so each caller reports it under
+                      its own counters.
+
+    Returns:
+        A dictionary mapping each URL to the result of `probe`, of
+        `host_down` for skipped URLs, or of `probe_error` for probes that
+        raised.
+    """
+    queues: dict[str, deque[str]] = {}
+    for url in dict.fromkeys(urls):
+        queues.setdefault(get_host(url), deque()).append(url)
+
+    results: dict[str, Any] = {}
+    in_flight: defaultdict[str, int] = defaultdict(int)
+    futures: dict[Future, tuple[str, str]] = {}
+    healthy_hosts: set[str] = set()
+    consecutive_failures: defaultdict[str, int] = defaultdict(int)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while queues or futures:
+            # Hand out at most one URL per host per round until the pool is full
+            submitted = True
+            while submitted and len(futures) < max_workers:
+                submitted = False
+                for host in list(queues):
+                    if len(futures) >= max_workers:
+                        break
+                    limit = per_host if host in healthy_hosts else 1
+                    if in_flight[host] >= limit:
+                        continue
+                    url = queues[host].popleft()
+                    if not queues[host]:
+                        del queues[host]
+                    futures[pool.submit(probe, url)] = (host, url)
+                    in_flight[host] += 1
+                    submitted = True
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                host, url = futures.pop(future)
+                in_flight[host] -= 1
+                try:
+                    results[url] = future.result()
+                except Exception as e:
+                    print(f"Probe of {url} failed: {e!r}")
+                    results[url] = probe_error(url, e)
+
+                if not is_failure(results[url]):
+                    healthy_hosts.add(host)
+                    consecutive_failures[host] = 0
+                    continue
+                consecutive_failures[host] += 1
+                if consecutive_failures[host] >= breaker_threshold and host in queues:
+                    skipped = list(queues.pop(host))
+                    on_host_down(host, skipped)
+                    for skipped_url in skipped:
+                        results[skipped_url] = host_down(skipped_url)
+
+    return results
+
+
+def get_failure_backoff(failures: int) -> float:
+    return min(FAILURE_BACKOFF_BASE * 2 ** (failures - 1), FAILURE_BACKOFF_MAX)
+
+
+def is_cache_fresh(entry: dict[str, Any], now: float) -> bool:
+    """
+    A cached result is fresh while a healthy stream is younger than
+    HEALTHY_TTL, or while a dead stream is still inside its backoff window.
+    """
+    failures: int = entry.get("failures", 0)
+    if failures == 0:
+        max_age = HEALTHY_TTL
+    else:
+        max_age = get_failure_backoff(failures)
+    return now - entry.get("checked", 0) < max_age
+
+
+def update_cache_entry(
+    entry: dict[str, Any] | None, probe: dict[str, Any], now: float
+) -> dict[str, Any]:
+    if probe.get("reason") == "host_down":
+        # The URL wasn't probed, so its last result and backoff stand. It is
+        # left due, to be probed again on the next run.
+        if entry is not None:
+            return entry
+        return {
+            "result": None,
+            "latency": None,
+            "checked": 0,
+            "failures": 0,
+            "reason": "host_down",
+            "latencies": [],
+            "quality": None,
+        }
+    result: dict | None = probe["stream"]
+    failures: int = 0 if result is not None else (entry or {}).get("failures", 0) + 1
+    # Only successful probes say how long the stream normally takes to answer
+    latencies: list[float] = list((entry or {}).get("latencies") or [])
+    if result is not None:
+        latencies = (latencies + [probe["latency"]])[-LATENCY_HISTORY:]
+    return {
+        "result": result,
+        "latency": probe["latency"],
+        "checked": now,
+        "failures": failures,
+        "reason": probe.get("reason"),
+        "latencies": latencies,
+        # Deep-check results stay until the stream breaks or is sampled again
+        "quality": (entry or {}).get("quality") if result is not None else None,
+    }
+
+
 def process_channels(
-    channels: list[dict[str, str | int | list[str]]],
-    output: str = "data/iptv_database_info.json",
+    store: ChannelStore,
+    max_workers: int = MAX_WORKERS,
+    per_host: int = MAX_PER_HOST,
+    full: bool = False,
+    deep: bool = False,
 ) -> None:
-    updated_channels: list[dict[str, str | int | list[str] | bool]] = []
-    for channel in channels:
-        stream_url: str = channel["url"]
-        channel_info: dict = deepcopy(channel)
-        stream_info: dict = get_stream_info(stream_url)
-        main_stream: dict = get_best_stream(stream_info)
+    """
+    Probes the channels' streams, saves the results in the store and exports
+    the updated stream info to data/iptv_database_info.json.
+
+    URLs with a fresh probe result are not probed again unless `full` is set.
+    If `deep` is set, the first segments of every working stream are
+    downloaded as well to measure their startup time and throughput.
+    """
+    now: float = time.time()
+    probes: dict[str, dict[str, Any]] = store.load_probes()
+    urls: list[str] = []
+    for channel in store.channels():
+        urls.extend(get_candidate_urls(channel))
+    urls = list(dict.fromkeys(urls))
+    stale_urls: list[str] = [
+        url
+        for url in urls
+        if full or url not in probes or not is_cache_fresh(probes[url], now)
+    ]
+    print(f"Using {len(urls) - len(stale_urls)} cached probe results")
+    metrics.increment("probe_cache_hits", len(urls) - len(stale_urls))
+    # URLs that worked last time go first, so each host's canary is one that
+    # is expected to work
+    stale_urls.sort(key=lambda url: (probes.get(url) or {}).get("result") is None)
+
+    def probe(url: str) -> dict[str, Any]:
+        return probe_url(url, client, get_probe_timeout(probes.get(url)))
+
+    start: float = time.perf_counter()
+    with create_http_client(max_workers) as client:
+        probed: dict[str, Any] = run_probes(
+            stale_urls, probe, max_workers=max_workers, per_host=per_host
+        )
+    end: float = time.perf_counter()
+
+    elapsed: float = end - start
+    m, s = divmod(elapsed, 60)
+    skipped: int = sum(probe.get("reason") == "host_down" for probe in probed.values())
+    probed_count: int = len(probed) - skipped
+    rate: float = probed_count / elapsed if elapsed > 0 else 0.0
+    print(f"Probed {probed_count} streams in {m:.0f}m{s:.2f}s ({rate:.2f} probes/s)")
 
-        if main_stream is not None:
-            channel_info["width"] = main_stream.get("width", 0)
-            channel_info["height"] = main_stream.get("height", 0)
-            channel_info["fps"] = main_stream.get("fps", 0)
-            channel_info["codec"] = main_stream.get("codec", "unknown")
-            channel_info["bitrate"] = main_stream.get("bitrate", 0)
-            channel_info["working"] = True
-        else:
-            channel_info["working"] = False
+    # Only keep results for URLs that are still in use
+    probes = {
+        url: (
+            update_cache_entry(probes.get(url), probed[url], now)
+            if url in probed
+            else probes[url]
+        )
+        for url in urls
+    }
+
+    if deep:
+        from stream_sampler import sample_streams
+
+        working_urls = [url for url in urls if probes[url]["result"] is not None]
+        for url, quality in sample_streams(working_urls, max_workers, per_host).items():
+            probes[url]["quality"] = quality
+            result = probes[url]["result"]
+            if quality and result.get("bitrate") is None:
+                result["bitrate"] = quality.get("bandwidth") or quality.get("bitrate")
+
+    store.save_probes(probes)
+    store.refresh_status(probes)
+
+    metrics.increment("streams_probed", probed_count)
+    for probe in probed.values():
+        # Streams skipped by the circuit breaker are in probes_skipped_host_down
+        if probe.get("reason") == "host_down":
+            continue
+        metrics.increment(
+            "streams_working" if probe["stream"] is not None else "streams_failed"
+        )
 
-        updated_channels.append(channel_info)
+    working: int = len(store.channels(working=True))
+    metrics.increment("channels_working", working)
+    metrics.increment("channels_failed", len(store.channels()) - working)
 
-    with open(output, "w", encoding="utf-8") as f:
-        json.dump(updated_channels, f, indent=2)
+    store.export_json()
 
 
 # url = "http://fl1.moveonjoy.com/MLB_1/index.m3u8"
@@ -110,9 +629,20 @@ def process_channels(
 # print(url, main_stream, sep="\n")
 
 
-def main():
-    process_channels(json_db)
+def main(full: bool = False, deep: bool = False) -> None:
+    with ChannelStore.open() as store:
+        process_channels(store, full=full, deep=deep)
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Check the IPTV database streams.")
+    parser.add_argument(
+        "--full", action="store_true", help="probe every stream, ignoring the cache"
+    )
+    parser.add_argument(
+        "--deep",
+        action="store_true",
+        help="also download the first segments of working streams",
+    )
+    args = parser.parse_args()
+    main(full=args.full, deep=args.deep)
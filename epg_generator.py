@@ -1,37 +1,32 @@
+import gzip
+import os
 import re
 import xml.etree.ElementTree as ET
+import zlib
 from datetime import datetime, timedelta, timezone
-from xml.dom import minidom
+from typing import Iterable, Iterator
+from xml.sax.saxutils import escape, quoteattr
 
+import metrics
+from output_utils import write_output
 
-def create_epg_from_m3u(
-    m3u_content: str, days_to_generate: int = 2, block_hours: int = 1
-) -> str:
-    """
-    Parses M3U playlist content and creates an EPG XML with hourly program blocks
-    starting from the current time.
-    """
-    root = ET.Element("tv")
-    root.set("generator-info-name", "Gemini-EPG-Generator")
-
-    # Calculate time range
-    # Round down to the nearest hour for a cleaner look
-    now = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+# XMLTV Format: YYYYMMDDhhmmss +0000
+XMLTV_TIME_FORMAT: str = "%Y%m%d%H%M%S +0000"
 
-    # Total number of blocks to generate
-    total_hours = days_to_generate * 24
-    num_blocks = int(total_hours / block_hours)
 
+def get_epg_channels(m3u_content: str) -> list[tuple[str, str]]:
+    """
+    Reads the (tvg-id, name) pairs of an M3U playlist, once per tvg-id.
+    """
+    channels: list[tuple[str, str]] = []
     processed_ids = set()
-    lines = m3u_content.strip().split("\n")
 
-    for line in lines:
+    for line in m3u_content.strip().split("\n"):
         if line.startswith("#EXTINF"):
             # Extract the tvg-id
             tvg_id_match = re.search(r'tvg-id="([^"]*)"', line)
 
-            # If no tvg-id exists, we can't link EPG to channel, so skip or generate a fake one
-            # Here we skip to be safe, but you could use the channel name as ID
+            # If no tvg-id exists, we can't link EPG to channel, so skip it
             if not tvg_id_match:
                 continue
 
@@ -46,57 +41,195 @@ def create_epg_from_m3u(
 
             # The channel name is the text after the last comma
             channel_name = line.split(",")[-1].strip()
+            channels.append((channel_id, channel_name))
 
-            # 1. Create the <channel> element
-            channel_el = ET.SubElement(root, "channel")
-            channel_el.set("id", channel_id)
-            display_name_el = ET.SubElement(channel_el, "display-name")
-            display_name_el.text = channel_name
+    return channels
 
-            # 2. Create multiple <programme> blocks
-            for i in range(num_blocks):
-                # Calculate start and stop for this specific block
-                start_dt = now + timedelta(hours=i * block_hours)
-                stop_dt = start_dt + timedelta(hours=block_hours)
 
-                # XMLTV Format: YYYYMMDDhhmmss +0000
-                fmt = "%Y%m%d%H%M%S +0000"
+def parse_xmltv_time(value: str) -> datetime:
+    return datetime.strptime(value, XMLTV_TIME_FORMAT).replace(tzinfo=timezone.utc)
 
-                programme_el = ET.SubElement(root, "programme")
-                programme_el.set("start", start_dt.strftime(fmt))
-                programme_el.set("stop", stop_dt.strftime(fmt))
-                programme_el.set("channel", channel_id)
 
-                title_el = ET.SubElement(programme_el, "title")
-                title_el.set("lang", "en")
-                # Display channel name as the show title
-                title_el.text = channel_name
+def load_guide(path: str) -> dict[str, tuple[str, list[tuple[str, str]]]]:
+    """
+    Reads a guide written by this module, so the next one can reuse it.
 
-                # Optional: Add description so it looks populated
-                desc_el = ET.SubElement(programme_el, "desc")
-                desc_el.set("lang", "en")
-                desc_el.text = f"Continuous streaming of {channel_name}"
+    Returns:
+        A dictionary mapping each channel's tvg-id to its name and its
+        programmes, as (stop time, serialized <programme>) pairs in order.
+    """
+    guide: dict[str, tuple[str, list[tuple[str, str]]]] = {}
+    with open(path, "rb") as f:
+        gzipped = f.read(2) == b"\x1f\x8b"
+    with (gzip.open(path, "rb") if gzipped else open(path, "rb")) as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == "channel":
+                name = elem.findtext("display-name") or ""
+                guide[elem.get("id")] = (name, [])
+            elif elem.tag == "programme":
+                channel = guide.get(elem.get("channel"))
+                if channel is not None:
+                    elem.tail = None
+                    markup = "  " + ET.tostring(elem, encoding="unicode") + "\n"
+                    channel[1].append((elem.get("stop"), markup))
+            else:
+                continue
+            elem.clear()
+    return guide
 
-    # Convert the XML tree to a formatted string
-    # (minidom is slow for massive files, but fine for typical usage)
-    xml_str = ET.tostring(root, "utf-8")
-    dom = minidom.parseString(xml_str)
-    return dom.toprettyxml(indent="  ")
 
+def iter_epg(
+    channels: Iterable[tuple[str, str]],
+    days_to_generate: int = 2,
+    block_hours: int = 1,
+    start: datetime | None = None,
+    previous: dict[str, tuple[str, list[tuple[str, str]]]] | None = None,
+) -> Iterator[str]:
+    """
+    Generates an XMLTV guide with one programme per channel per block, piece
+    by piece, so it can be written out without building the document in
+    memory.
+
+    If the previous guide is given, it is updated instead of rebuilt: the
+    programmes of channels that are still in it (under the same name) are
+    kept unless they have ended, and only the blocks past their last
+    programme are generated.
+
+    Args:
+        channels: The (tvg-id, name) pairs of the channels.
+        days_to_generate: How many days the guide covers.
+        block_hours: The length of each programme block.
+        start: The start of the first block. Defaults to the current hour.
+        previous: The previous guide, as returned by `load_guide`.
+
+    Yields:
+        Chunks of the XML document.
+    """
+    # Round down to the nearest hour for a cleaner look
+    if start is None:
+        start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    window_end = start + timedelta(hours=days_to_generate * 24)
+    block = timedelta(hours=block_hours)
+    previous = previous or {}
+
+    # Block timestamps are formatted once per first block and shared by all
+    # channels that continue from it
+    blocks_from: dict[datetime, list[tuple[str, str]]] = {}
+
+    def get_blocks(first: datetime) -> list[tuple[str, str]]:
+        if first not in blocks_from:
+            blocks = []
+            block_start = first
+            while block_start + block <= window_end:
+                blocks.append(
+                    (
+                        block_start.strftime(XMLTV_TIME_FORMAT),
+                        (block_start + block).strftime(XMLTV_TIME_FORMAT),
+                    )
+                )
+                block_start += block
+            blocks_from[first] = blocks
+        return blocks_from[first]
+
+    # XMLTV expects every <channel> before the first <programme>
+    channels = list(channels)
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<tv generator-info-name="Gemini-EPG-Generator">\n'
+
+    for channel_id, channel_name in channels:
+        yield (
+            f"  <channel id={quoteattr(channel_id)}>\n"
+            f"    <display-name>{escape(channel_name)}</display-name>\n"
+            "  </channel>\n"
+        )
+
+    kept = added = dropped = 0
+    for channel_id, channel_name in channels:
+        next_start = start
+        previous_name, programmes = previous.get(channel_id, (None, []))
+        if previous_name == channel_name:
+            for stop, markup in programmes:
+                stop_time = parse_xmltv_time(stop)
+                if stop_time <= start:
+                    dropped += 1
+                    continue
+                kept += 1
+                next_start = stop_time
+                yield markup
+
+        channel_attr = quoteattr(channel_id)
+        # Display channel name as the show title, with a description so the
+        # guide looks populated
+        title = escape(channel_name)
+        details = (
+            f'    <title lang="en">{title}</title>\n'
+            f'    <desc lang="en">Continuous streaming of {title}</desc>\n'
+            "  </programme>\n"
+        )
+        for start_str, stop_str in get_blocks(next_start):
+            added += 1
+            yield (
+                f'  <programme start="{start_str}" stop="{stop_str}" '
+                f"channel={channel_attr}>\n{details}"
+            )
+
+    yield "</tv>\n"
+    if previous:
+        print(f"EPG: kept {kept} programmes, added {added}, dropped {dropped}")
+
+
+def gzip_chunks(chunks: Iterable[str]) -> Iterator[bytes]:
+    """
+    Compresses text chunks into a gzip stream. The header carries no
+    timestamp, so identical content always compresses to identical bytes.
+    """
+    compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def write_epg(path: str, chunks: Iterable[str]) -> bool:
+    """
+    Streams an XMLTV document to `path`, gzip-compressed if it ends in .gz.
+    Returns True if the file changed.
+    """
+    if path.endswith(".gz"):
+        return write_output(path, gzip_chunks(chunks))
+    return write_output(path, chunks)
 
-def write_youtube_epg_file():
+
+def create_epg_from_m3u(
+    m3u_content: str, days_to_generate: int = 2, block_hours: int = 1
+) -> str:
+    """
+    Parses M3U playlist content and creates an EPG XML with hourly program blocks
+    starting from the current time.
+    """
+    channels = get_epg_channels(m3u_content)
+    return "".join(iter_epg(channels, days_to_generate, block_hours))
+
+
+def write_youtube_epg_file(path: str = "output/youtube_epg.xml"):
     try:
         with open(
             "output/playlists/playlist_youtube.m3u", "r", encoding="utf-8"
         ) as m3u_file:
             m3u_content = m3u_file.read()
 
-        epg_xml = create_epg_from_m3u(m3u_content)
-
-        with open("output/youtube_epg.xml", "w", encoding="utf-8") as f:
-            f.write(epg_xml)
-
-        print("EPG successfully generated.")
+        # Update the previous guide rather than rebuilding it
+        previous = None
+        if os.path.exists(path):
+            try:
+                previous = load_guide(path)
+            except (ET.ParseError, EOFError, OSError, ValueError) as e:
+                print(f"Rebuilding {path}, the previous guide is unreadable: {e!r}")
+
+        with metrics.timed("epg_build"):
+            channels = get_epg_channels(m3u_content)
+            write_epg(path, iter_epg(channels, previous=previous))
     except FileNotFoundError:
         print("Error: output/playlists/playlist_youtube.m3u not found.")
 
@@ -0,0 +1,227 @@
+import gzip
+import json
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+from urllib.parse import urlsplit
+
+import httpx
+
+import metrics
+from epg_generator import write_epg
+
+EPG_LINKS_PATH: str = "data/epg_links.txt"
+# Downloaded sources and their ETag/Last-Modified, kept out of git
+EPG_CACHE_DIR: str = "data/epg_cache"
+MERGED_EPG_PATH: str = "output/epg.xml.gz"
+
+DOWNLOAD_TIMEOUT: httpx.Timeout = httpx.Timeout(60.0, connect=10.0)
+MAX_DOWNLOADS: int = 4
+
+
+def load_epg_links(path: str = EPG_LINKS_PATH) -> list[str]:
+    with open(path, "r", encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip() and not line.startswith("#")]
+
+
+def get_cache_path(url: str, cache_dir: str = EPG_CACHE_DIR) -> str:
+    name = url.split("://", 1)[-1].replace("/", "_")
+    return os.path.join(cache_dir, name)
+
+
+def load_cache_state(cache_dir: str = EPG_CACHE_DIR) -> dict[str, dict]:
+    path = os.path.join(cache_dir, "state.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_cache_state(state: dict[str, dict], cache_dir: str = EPG_CACHE_DIR) -> None:
+    with open(os.path.join(cache_dir, "state.json"), "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def download_source(
+    url: str, client: httpx.Client, state: dict | None, cache_dir: str = EPG_CACHE_DIR
+) -> tuple[str | None, dict | None]:
+    """
+    Downloads an EPG source into the cache, unless the cached copy is still
+    current (conditional GET).
+
+    Returns:
+        The path of the cached file (None if the download failed) and the
+        source's new cache state.
+    """
+    path = get_cache_path(url, cache_dir)
+    headers: dict[str, str] = {}
+    if state and os.path.exists(path):
+        if state.get("etag"):
+            headers["If-None-Match"] = state["etag"]
+        if state.get("last_modified"):
+            headers["If-Modified-Since"] = state["last_modified"]
+
+    try:
+        with client.stream("GET", url, headers=headers) as response:
+            if response.status_code == 304:
+                print(f"Not modified: {url}")
+                return path, state
+            response.raise_for_status()
+
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, prefix=".tmp-")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for chunk in response.iter_bytes():
+                        f.write(chunk)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            print(f"Downloaded {response.num_bytes_downloaded / 1024:.0f} KiB: {url}")
+            metrics.increment("bytes_downloaded", response.num_bytes_downloaded)
+            return path, {
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+    except httpx.HTTPError as e:
+        print(f"Failed to download {url}: {e!r}")
+        # Fall back to the previous copy if there is one
+        if os.path.exists(path):
+            return path, state
+        return None, None
+
+
+def download_sources(
+    urls: list[str], cache_dir: str = EPG_CACHE_DIR
+) -> dict[str, str | None]:
+    """
+    Downloads the EPG sources concurrently. Returns each URL's cached file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    state = load_cache_state(cache_dir)
+
+    def timed_download(url: str) -> tuple[str | None, dict | None]:
+        with metrics.timed("epg_download", urlsplit(url).hostname or ""):
+            return download_source(url, client, state.get(url), cache_dir)
+
+    with httpx.Client(timeout=DOWNLOAD_TIMEOUT, follow_redirects=True) as client:
+        with ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as pool:
+            results = list(pool.map(timed_download, urls))
+
+    paths: dict[str, str | None] = {}
+    for url, (path, url_state) in zip(urls, results):
+        paths[url] = path
+        if url_state is not None:
+            state[url] = url_state
+    save_cache_state(state, cache_dir)
+    return paths
+
+
+def open_source(path: str):
+    """
+    Opens an XMLTV file for reading, decompressing it on the fly if it is
+    gzipped (detected from its content, not its name).
+    """
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == b"\x1f\x8b":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+def iter_source_elements(path: str) -> Iterator[ET.Element]:
+    """
+    Yields the top-level <channel> and <programme> elements of an XMLTV file
+    one at a time. Each element is cleared once the caller moves on, so memory
+    stays bounded however large the file is.
+    """
+    with open_source(path) as f:
+        root = None
+        for event, elem in ET.iterparse(f, events=("start", "end")):
+            if event == "start":
+                if root is None:
+                    root = elem
+                continue
+            if elem.tag in ("channel", "programme"):
+                yield elem
+                elem.clear()
+                # Drop the cleared element from the root as well
+                root.clear()
+
+
+def merge_epg_sources(paths: Iterable[str], channel_ids: set[str], spool) -> list[str]:
+    """
+    Merges XMLTV files, keeping only the channels in `channel_ids`. A channel's
+    programmes are taken from the first source that lists the channel.
+
+    Args:
+        paths: The XMLTV files, in order of preference.
+        channel_ids: The tvg-ids to keep.
+        spool: A text file the kept <programme> elements are written to.
+
+    Returns:
+        The kept <channel> elements, serialized.
+    """
+    channels: list[str] = []
+    owners: dict[str, str] = {}
+
+    for path in paths:
+        kept_programmes = 0
+        try:
+            for elem in iter_source_elements(path):
+                elem.tail = "\n"
+                if elem.tag == "channel":
+                    channel_id = elem.get("id")
+                    if channel_id in channel_ids and channel_id not in owners:
+                        owners[channel_id] = path
+                        channels.append("  " + ET.tostring(elem, encoding="unicode"))
+                elif owners.get(elem.get("channel")) == path:
+                    spool.write("  " + ET.tostring(elem, encoding="unicode"))
+                    kept_programmes += 1
+        except (ET.ParseError, EOFError, OSError) as e:
+            # Keep whatever was read before the file turned out to be broken
+            print(f"Failed to parse {path}: {e!r}")
+        print(f"Kept {kept_programmes} programmes from {path}")
+
+    return channels
+
+
+def iter_merged_epg(channels: list[str], spool) -> Iterator[str]:
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<tv generator-info-name="CrIPTV-EPG-Merger">\n'
+    yield from channels
+    spool.seek(0)
+    while chunk := spool.read(1024 * 1024):
+        yield chunk
+    yield "</tv>\n"
+
+
+def write_merged_epg(
+    channel_ids: set[str],
+    urls: list[str] | None = None,
+    output: str = MERGED_EPG_PATH,
+) -> bool:
+    """
+    Downloads the sources in data/epg_links.txt and writes a single EPG with
+    only the channels in `channel_ids`. Returns True if the output changed.
+    """
+    if urls is None:
+        urls = load_epg_links()
+    paths = download_sources(urls)
+
+    with tempfile.TemporaryFile("w+", encoding="utf-8") as spool:
+        channels = merge_epg_sources(
+            [path for path in paths.values() if path is not None], channel_ids, spool
+        )
+        missing = len(channel_ids) - len(channels)
+        print(f"Merged EPG covers {len(channels)} channels ({missing} without a guide)")
+        return write_epg(output, iter_merged_epg(channels, spool))
+
+
+if __name__ == "__main__":
+    with open("data/iptv_database.json", "r", encoding="utf-8") as f:
+        database = json.load(f)
+    write_merged_epg({channel["tvg-id"] for channel in database if channel["tvg-id"]})
@@ -0,0 +1,145 @@
+import re
+
+from channel_store import HD_MIN_HEIGHT, Channel, ChannelStore, is_reliable
+from logo_index import load_logo_urls
+from m3u_utils import generate_playlist
+from output_utils import write_output
+
+
+def sort_channels(channels: list) -> list:
+    from natsort import natsorted
+
+    return natsorted(channels, key=lambda ch: ch["name"].casefold())
+
+
+def resolve_playlists(
+    playlists: dict[str, dict], store: ChannelStore
+) -> dict[str, list[Channel]]:
+    """
+    Resolves the tvg-ids of every playlist in playlists.yaml to working
+    channels. Channels follow the order of the ids in the YAML file, and ids
+    that are listed more than once in a playlist are reported and only added
+    once.
+    """
+    resolved: dict[str, list[Channel]] = {}
+    for playlist, data in playlists.items():
+        channel_ids: dict[str, list[Channel]] = {}
+        for channel_id in data["ids"]:
+            if channel_id in channel_ids:
+                print(f"Duplicate id in {playlist}: {channel_id}")
+                continue
+            channel_ids[channel_id] = []
+
+        for channel in store.channels("info", working=True, tvg_ids=channel_ids):
+            channel_ids[channel["tvg-id"]].append(channel)
+        resolved[playlist] = [
+            channel for channels in channel_ids.values() for channel in channels
+        ]
+    return resolved
+
+
+def generate_iptv_playlists(
+    store: ChannelStore | None = None,
+    changed_ids: set[str] | None = None,
+    logo_urls: dict[str, str] | None = None,
+):
+    """
+    Updates the main playlist and specific playlists from the channel store.
+
+    If `changed_ids` is given, only the working channels with those tvg-ids
+    changed, so only the playlists that depend on them are updated.
+    Logos point at their mirrored copies in `logo_urls` (by default, the
+    ones in the logo mirror's index).
+    """
+    from ruamel.yaml import YAML
+
+    if store is None:
+        with ChannelStore.open() as store:
+            return generate_iptv_playlists(store, changed_ids, logo_urls)
+    if logo_urls is None:
+        logo_urls = load_logo_urls()
+
+    print("Starting IPTV playlist generation...")
+
+    # Update the main M3U file (it doesn't depend on the channels' status)
+    if changed_ids is None:
+        playlist_content = generate_playlist(
+            sort_channels(store.channels()), logo_urls=logo_urls
+        )
+        write_output("output/playlists/playlist_iptv.m3u", playlist_content)
+
+    # Update the working M3U file
+    playlist_data = store.channels("info", working=True)
+    playlist_content = generate_playlist(
+        sort_channels(playlist_data), logo_urls=logo_urls
+    )
+    write_output("output/playlists/playlist_iptv_working.m3u", playlist_content)
+
+    # Update the reliable HD M3U file (channels that passed a deep check)
+    playlist_data = [
+        channel
+        for channel in store.channels("info", working=True, min_height=HD_MIN_HEIGHT)
+        if is_reliable(channel.quality)
+    ]
+    playlist_content = generate_playlist(
+        sort_channels(playlist_data), logo_urls=logo_urls
+    )
+    write_output("output/playlists/playlist_iptv_reliable_hd.m3u", playlist_content)
+
+    # Update specific playlists from YAML configuration
+    yaml = YAML(typ="safe")
+    with open("playlists.yaml", "r") as f:
+        playlists = yaml.load(f)
+
+    if changed_ids is not None:
+        playlists["playlists"] = {
+            playlist: data
+            for playlist, data in playlists["playlists"].items()
+            if changed_ids.intersection(data["ids"])
+        }
+    resolved = resolve_playlists(playlists["playlists"], store)
+    for playlist, matching_channels in resolved.items():
+        playlist_content = generate_playlist(matching_channels, logo_urls=logo_urls)
+        write_output(f"output/playlists/{playlist}.m3u", playlist_content)
+
+    print("Finished IPTV playlist generation.")
+
+
+def generate_full_iptv_playlist(
+    store: ChannelStore | None = None, logo_urls: dict[str, str] | None = None
+):
+    if store is None:
+        with ChannelStore.open() as store:
+            return generate_full_iptv_playlist(store, logo_urls)
+    if logo_urls is None:
+        logo_urls = load_logo_urls()
+
+    full_playlist_data = []
+    seen_channel_urls = set()
+    for channel in store.channels():
+        if not len(channel["commented_urls"]):
+            full_playlist_data.append(channel)
+        else:
+            urls = []
+            if channel["url"] not in seen_channel_urls:
+                urls.append(channel["url"])
+                seen_channel_urls.add(channel["url"])
+
+            for commented_url in channel["commented_urls"]:
+                url = re.sub(r"^#\s*", "", commented_url)
+                if url not in seen_channel_urls:
+                    urls.append(url)
+                    seen_channel_urls.add(url)
+
+            for enum, url in enumerate(urls, start=1):
+                new_channel = channel.to_dict()
+                new_channel["url"] = url
+                new_channel["tvg-name"] = f"{channel['tvg-name']} ({enum})"
+                new_channel["name"] = f"{channel['name']} ({enum})"
+                new_channel["commented_urls"] = []
+                full_playlist_data.append(new_channel)
+
+    playlist_content = generate_playlist(
+        sort_channels(full_playlist_data), logo_urls=logo_urls
+    )
+    write_output("output/playlists/playlist_all.m3u", playlist_content)
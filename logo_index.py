@@ -0,0 +1,54 @@
+import json
+import os
+from typing import Any
+
+# Each logo URL's mirrored file, thumbnails and ETag/Last-Modified
+LOGO_INDEX_PATH: str = "data/logo_index.json"
+# Where the playlists point at the mirrored logos. raw.githubusercontent.com
+# serves them directly, without github.com's redirect.
+LOGO_BASE_URL: str = "https://raw.githubusercontent.com/Crankrune/CrIPTV/main/output/logos"
+# Playlists use the thumbnail of this size when the original is larger
+PLAYLIST_LOGO_SIZE: int = 256
+
+
+def load_logo_index(path: str = LOGO_INDEX_PATH) -> dict[str, dict[str, Any]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_logo_index(
+    index: dict[str, dict[str, Any]], path: str = LOGO_INDEX_PATH
+) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def get_logo_urls(
+    index: dict[str, dict[str, Any]], base_url: str = LOGO_BASE_URL
+) -> dict[str, str]:
+    """
+    Returns the URL of each mirrored logo's copy (or of its thumbnail, if the
+    original is larger), by original URL.
+    """
+    base_url = base_url.rstrip("/")
+    logo_urls: dict[str, str] = {}
+    for url, entry in index.items():
+        if not entry.get("file"):
+            continue
+        thumbnails = entry.get("thumbnails") or {}
+        file = thumbnails.get(str(PLAYLIST_LOGO_SIZE), entry["file"])
+        logo_urls[url] = f"{base_url}/{file}"
+    return logo_urls
+
+
+def load_logo_urls(
+    index_path: str = LOGO_INDEX_PATH, base_url: str = LOGO_BASE_URL
+) -> dict[str, str]:
+    """
+    Returns the mirrored logo URLs to use in the playlists, by original URL.
+    Only reads the index, so the playlist generators and the server don't
+    import the mirror (httpx, Pillow and the stream checker).
+    """
+    return get_logo_urls(load_logo_index(index_path), base_url)
@@ -0,0 +1,354 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Iterable
+
+import httpx
+
+import metrics
+from channel_store import ChannelStore, get_host
+from check_streams import HOST_FAILURE_REASONS, classify_http_error, run_probes
+from logo_index import (
+    LOGO_BASE_URL,
+    LOGO_INDEX_PATH,
+    PLAYLIST_LOGO_SIZE,
+    get_logo_urls,
+    load_logo_index,
+    save_logo_index,
+)
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional, logos are mirrored without thumbnails
+    Image = None
+
+# Logos are stored under their content hash, so identical images downloaded
+# from different URLs are only stored once
+LOGO_DIR: str = "output/logos"
+
+MAX_WORKERS: int = 16
+MAX_PER_HOST: int = 8
+LOGO_TIMEOUT: httpx.Timeout = httpx.Timeout(15.0, connect=10.0)
+MAX_LOGO_BYTES: int = 5 * 1024 * 1024
+# Mirrored logos are revalidated (conditional GET) once a day. Broken ones are
+# retried every run.
+REFRESH_INTERVAL: int = 24 * 3600
+# Logos no playlist has used for this long are dropped from the mirror
+MAX_UNUSED_AGE: int = 7 * 24 * 3600
+
+# Longest side of the resized variants (Pillow only). Playlists use the
+# PLAYLIST_LOGO_SIZE variant when the original is larger.
+THUMBNAIL_SIZES: tuple[int, ...] = (128, PLAYLIST_LOGO_SIZE)
+
+IMAGE_SIGNATURES: tuple[tuple[bytes, str], ...] = (
+    (b"\x89PNG\r\n\x1a\n", ".png"),
+    (b"\xff\xd8\xff", ".jpg"),
+    (b"GIF87a", ".gif"),
+    (b"GIF89a", ".gif"),
+    (b"\x00\x00\x01\x00", ".ico"),
+)
+
+
+def get_image_extension(data: bytes) -> str | None:
+    """
+    Identifies an image from its first bytes. Returns its file extension, or
+    None if the data is not an image (e.g. an HTML error page).
+    """
+    for signature, extension in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return extension
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return ".webp"
+    head = data[:1024].lstrip().lower()
+    if head.startswith(b"<svg") or (head.startswith(b"<?xml") and b"<svg" in head):
+        return ".svg"
+    return None
+
+
+def write_logo(path: str, data: bytes) -> None:
+    """
+    Atomically writes a mirrored file, unless it already exists. Files are
+    named after their content, so an existing file is already up to date.
+    """
+    if os.path.exists(path):
+        return
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def make_thumbnails(data: bytes, name: str, logo_dir: str) -> dict[str, str]:
+    """
+    Writes PNG variants of an image scaled down to each of THUMBNAIL_SIZES.
+    Sizes the image already fits in are skipped.
+    Raises OSError or ValueError if Pillow can't decode the image.
+
+    Returns:
+        The file of each variant, by size.
+    """
+    thumbnails: dict[str, str] = {}
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        for size in THUMBNAIL_SIZES:
+            if max(image.size) <= size:
+                continue
+            file = f"{name}-{size}.png"
+            path = os.path.join(logo_dir, file)
+            if not os.path.exists(path):
+                thumbnail = image.convert("RGBA")
+                thumbnail.thumbnail((size, size))
+                buffer = io.BytesIO()
+                thumbnail.save(buffer, "PNG", optimize=True)
+                write_logo(path, buffer.getvalue())
+            thumbnails[str(size)] = file
+    return thumbnails
+
+
+def fetch_logo(
+    url: str, entry: dict[str, Any] | None, client: httpx.Client, logo_dir: str
+) -> dict[str, Any]:
+    """
+    Downloads a logo into the mirror, unless the mirrored copy is still
+    current (conditional GET).
+
+    Returns:
+        The fields of the logo's index entry to update. `error` says why the
+        logo is broken, and is None if it isn't.
+    """
+    headers: dict[str, str] = {}
+    # A logo mirrored before Pillow was installed is downloaded again to make
+    # its thumbnails
+    if (
+        entry
+        and entry.get("file")
+        and os.path.exists(os.path.join(logo_dir, entry["file"]))
+        and (Image is None or "thumbnails" in entry)
+    ):
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+    try:
+        with metrics.timed("logo", get_host(url)):
+            with client.stream("GET", url, headers=headers) as response:
+                try:
+                    if response.status_code == 304:
+                        metrics.increment("logos_not_modified")
+                        return {"error": None}
+                    response.raise_for_status()
+                    data = b""
+                    for chunk in response.iter_bytes():
+                        data += chunk
+                        if len(data) > MAX_LOGO_BYTES:
+                            return {"error": "too_large"}
+                finally:
+                    metrics.increment(
+                        "bytes_downloaded", response.num_bytes_downloaded
+                    )
+    except httpx.HTTPError as e:
+        return {"error": classify_http_error(e)}
+
+    extension = get_image_extension(data)
+    if extension is None:
+        return {"error": "not_image"}
+
+    name = hashlib.sha256(data).hexdigest()[:16]
+    result: dict[str, Any] = {
+        "error": None,
+        "file": name + extension,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+    }
+    if Image is not None and extension != ".svg":
+        try:
+            result["thumbnails"] = make_thumbnails(data, name, logo_dir)
+        except (OSError, ValueError, Image.DecompressionBombError):
+            return {"error": "invalid_image"}
+    write_logo(os.path.join(logo_dir, result["file"]), data)
+    metrics.increment("logos_downloaded")
+    return result
+
+
+def is_logo_failure(result: dict[str, Any]) -> bool:
+    return result.get("error") in HOST_FAILURE_REASONS
+
+
+def report_logo_host_down(host: str, skipped: list[str]) -> None:
+    print(f"{host} looks down, skipping {len(skipped)} logos")
+    metrics.increment("logo_hosts_down")
+    metrics.increment("logos_skipped_host_down", len(skipped))
+
+
+class LogoMirror:
+    """
+    Content-addressed copies of the channel logos, and the index mapping each
+    logo URL to its copy.
+    """
+
+    def __init__(
+        self,
+        index_path: str = LOGO_INDEX_PATH,
+        logo_dir: str = LOGO_DIR,
+        base_url: str = LOGO_BASE_URL,
+    ) -> None:
+        self.index_path = index_path
+        self.logo_dir = logo_dir
+        self.base_url = base_url.rstrip("/")
+        self.index: dict[str, dict[str, Any]] = load_logo_index(index_path)
+
+    def mirror(
+        self,
+        urls: Iterable[str],
+        max_workers: int = MAX_WORKERS,
+        per_host: int = MAX_PER_HOST,
+    ) -> dict[str, str]:
+        """
+        Mirrors the logos at `urls` concurrently, with the same per-host
+        limits and circuit breaker as the stream probes. Logos revalidated
+        within REFRESH_INTERVAL aren't requested again.
+
+        Returns:
+            The reason each broken logo among `urls` is broken, by URL. A
+            broken logo keeps its previously mirrored copy, if any.
+        """
+        now = time.time()
+        urls = list(dict.fromkeys(url for url in urls if url.startswith("http")))
+        stale_urls: list[str] = []
+        for url in urls:
+            entry = self.index.setdefault(url, {})
+            entry["used"] = now
+            if (
+                entry.get("error") is not None
+                or not entry.get("file")
+                or now - entry.get("checked", 0) >= REFRESH_INTERVAL
+            ):
+                stale_urls.append(url)
+
+        if stale_urls:
+            os.makedirs(self.logo_dir, exist_ok=True)
+            start = time.perf_counter()
+            client = httpx.Client(
+                timeout=LOGO_TIMEOUT,
+                follow_redirects=True,
+                limits=httpx.Limits(
+                    max_connections=max_workers, max_keepalive_connections=max_workers
+                ),
+            )
+            with client:
+                results = run_probes(
+                    stale_urls,
+                    lambda url: fetch_logo(
+                        url, self.index[url], client, self.logo_dir
+                    ),
+                    max_workers=max_workers,
+                    per_host=per_host,
+                    is_failure=is_logo_failure,
+                    host_down=lambda url: {"error": "host_down"},
+                    probe_error=lambda url, error: {"error": "probe_error"},
+                    on_host_down=report_logo_host_down,
+                )
+            for url, result in results.items():
+                self.index[url].update(result, checked=now)
+            elapsed = time.perf_counter() - start
+            print(f"Checked {len(stale_urls)} logos in {elapsed:.2f}s")
+
+        broken = {
+            url: self.index[url]["error"]
+            for url in urls
+            if self.index[url].get("error") is not None
+        }
+        metrics.increment("logos_broken", len(broken))
+        return broken
+
+    def get_logo_urls(self) -> dict[str, str]:
+        """
+        Returns the URL of each mirrored logo's copy (or of its thumbnail, if
+        the original is larger), by original URL.
+        """
+        return get_logo_urls(self.index, self.base_url)
+
+    def prune(self, max_unused_age: float = MAX_UNUSED_AGE) -> int:
+        """
+        Drops the logos unused for `max_unused_age` seconds, and deletes the
+        files no remaining logo refers to. Returns the number of deleted files.
+        """
+        now = time.time()
+        self.index = {
+            url: entry
+            for url, entry in self.index.items()
+            if now - entry.get("used", 0) < max_unused_age
+        }
+        if not os.path.isdir(self.logo_dir):
+            return 0
+
+        referenced: set[str] = set()
+        for entry in self.index.values():
+            if entry.get("file"):
+                referenced.add(entry["file"])
+            referenced.update((entry.get("thumbnails") or {}).values())
+        deleted = 0
+        for name in os.listdir(self.logo_dir):
+            if name not in referenced:
+                os.remove(os.path.join(self.logo_dir, name))
+                deleted += 1
+        return deleted
+
+    def save(self) -> None:
+        save_logo_index(self.index, self.index_path)
+
+
+def get_logo_sources(
+    store: ChannelStore, youtube_channels_path: str = "data/youtube_channels.json"
+) -> dict[str, list[str]]:
+    """
+    Collects the logos of the IPTV and YouTube channels, with the names of
+    the channels using each.
+    """
+    sources: defaultdict[str, list[str]] = defaultdict(list)
+    for channel in store.channels():
+        if channel.tvg_logo:
+            sources[channel.tvg_logo].append(channel.name)
+    if os.path.exists(youtube_channels_path):
+        with open(youtube_channels_path, "r", encoding="utf-8") as f:
+            for channel in json.load(f):
+                if channel.get("tvg-logo"):
+                    sources[channel["tvg-logo"]].append(channel.get("name", ""))
+    return sources
+
+
+def mirror_logos(sources: dict[str, list[str]], mirror: LogoMirror | None = None):
+    """
+    Mirrors the logos of `sources` (see `get_logo_sources`), reports the
+    broken ones and drops the logos that are no longer used.
+    """
+    if mirror is None:
+        mirror = LogoMirror()
+
+    broken = mirror.mirror(sources)
+    for url, reason in sorted(broken.items()):
+        print(f"Broken logo ({reason}): {url} used by {', '.join(sources[url])}")
+    deleted = mirror.prune()
+    mirror.save()
+
+    files = {entry["file"] for entry in mirror.index.values() if entry.get("file")}
+    print(
+        f"Mirrored {len(sources) - len(broken)} of {len(sources)} logos as "
+        f"{len(files)} files, {len(broken)} broken, {deleted} files removed"
+    )
+
+
+if __name__ == "__main__":
+    with ChannelStore.open() as store:
+        mirror_logos(get_logo_sources(store))
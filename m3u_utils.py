@@ -1,69 +1,131 @@
 import re
+from typing import Container, Iterable, Iterator, Mapping
 
+EXTINF_PATTERN = re.compile(r"#EXTINF:\s*(-?\d+(?:\.\d+)?)\s*(.*)")
+ATTRIBUTE_PATTERN = re.compile(r'\s*([\w-]+)="([^"]*)"')
+GROUP_TITLE_PATTERN = re.compile(r'group-title="([^"]*)"')
+# The trimmed guide written by epg_merger, covering the channels in our database
+EPG_URL: str = "https://github.com/Crankrune/CrIPTV/raw/refs/heads/main/output/epg.xml.gz"
+STANDARD_ATTRIBUTES: tuple[str, ...] = ("tvg-id", "tvg-name", "tvg-logo", "group-title")
 
-def parse_playlist(playlist_content: str) -> list[dict]:
+
+def parse_extinf(line: str) -> dict | None:
     """
-    Parses the content of an M3U playlist, including commented-out URLs,
-    into a list of dictionaries.
+    Parses an #EXTINF line into a channel dictionary without any URLs.
 
     Args:
-        playlist_content: A string containing the M3U playlist data.
+        line: The #EXTINF line, e.g. '#EXTINF:-1 tvg-id="..." catchup="...",Name'.
 
     Returns:
-        A list of dictionaries, where each dictionary represents a channel
-        and includes a list of any commented-out URLs.
+        A channel dictionary, or None if the line is not a valid #EXTINF line.
+        Attributes other than the standard tvg-*/group-title ones are kept
+        under 'attributes'.
+    """
+    match = EXTINF_PATTERN.match(line)
+    if not match:
+        return None
+
+    duration_str, rest = match.groups()
+    attributes: dict[str, str] = {}
+    pos = 0
+    while attribute := ATTRIBUTE_PATTERN.match(rest, pos):
+        attributes[attribute.group(1)] = attribute.group(2)
+        pos = attribute.end()
+
+    # The channel name is everything after the comma that ends the attributes
+    if "," not in rest[pos:]:
+        return None
+    channel_name = rest[pos:].partition(",")[2]
+
+    return {
+        "tvg-id": attributes.pop("tvg-id", None),
+        "tvg-name": attributes.pop("tvg-name", None),
+        "tvg-logo": attributes.pop("tvg-logo", None),
+        "group-title": attributes.pop("group-title", None),
+        "name": channel_name.strip(),
+        "url": None,
+        "commented_urls": [],
+        "duration": float(duration_str) if "." in duration_str else int(duration_str),
+        "attributes": attributes,
+        "vlc_options": [],
+    }
+
+
+def iter_playlist(
+    lines: Iterable[str | bytes], group_titles: Container[str] | None = None
+) -> Iterator[dict]:
     """
-    # Split the playlist into chunks, with each chunk starting with #EXTINF
-    # The (?=...) is a positive lookahead to keep the delimiter
-    chunks = re.split(r"(?=#EXTINF)", playlist_content)
-    playlist_data = []
+    Parses an M3U playlist line by line, yielding each channel once the next
+    #EXTINF line (or the end of the playlist) is read. Works on anything that
+    yields lines, such as an open file or httpx's `Response.iter_lines()`.
 
-    extinf_pattern = re.compile(r"#EXTINF:-1 (.*),(.*)")
-    attributes_pattern = re.compile(r'(\S+?)="(.*?)"')
+    Args:
+        lines: The playlist lines, as strings or UTF-8 encoded bytes.
+        group_titles: If given, only channels whose group-title is in it are
+                      parsed; the lines of other channels are skipped.
+
+    Yields:
+        Channel dictionaries. The last URL line of a channel is its active
+        URL. Commented-out lines and earlier URL lines are kept in
+        'commented_urls', except for #EXTVLCOPT lines, which are kept in
+        'vlc_options'.
+    """
+    channel_info: dict | None = None
 
-    for chunk in chunks:
-        if not chunk.strip() or not chunk.startswith("#EXTINF"):
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode("utf-8", errors="replace")
+        line = line.strip().lstrip("\ufeff")
+        if not line:
             continue
 
-        lines = [line.strip() for line in chunk.strip().split("\n") if line.strip()]
-
-        # The first line is always the #EXTINF metadata
-        extinf_line = lines[0]
-        match = extinf_pattern.match(extinf_line)
-
-        if not match:
+        if line.startswith("#EXTINF"):
+            if channel_info is not None:
+                yield channel_info
+            channel_info = None
+            if group_titles is not None:
+                group_title = GROUP_TITLE_PATTERN.search(line)
+                if not group_title or group_title.group(1) not in group_titles:
+                    continue
+            channel_info = parse_extinf(line)
+        elif channel_info is None:
+            # Header lines, or lines of a skipped channel
             continue
+        elif line.startswith("#EXTVLCOPT"):
+            channel_info["vlc_options"].append(line)
+        elif line.startswith("#"):
+            channel_info["commented_urls"].append(line)
+        else:
+            # The last non-commented line is the active URL, as written by
+            # generate_playlist after the commented-out ones
+            if channel_info["url"] is not None:
+                channel_info["commented_urls"].append(channel_info["url"])
+            channel_info["url"] = line
 
-        attributes_str = match.group(1).strip()
-        channel_name = match.group(2).strip()
-        attributes = dict(attributes_pattern.findall(attributes_str))
+    if channel_info is not None:
+        yield channel_info
 
-        channel_info = {
-            "tvg-id": attributes.get("tvg-id"),
-            "tvg-name": attributes.get("tvg-name"),
-            "tvg-logo": attributes.get("tvg-logo"),
-            "group-title": attributes.get("group-title"),
-            "name": channel_name,
-            "url": None,
-            "commented_urls": [],
-        }
 
-        # Process the subsequent lines for URLs
-        for i in range(1, len(lines)):
-            line = lines[i]
-            if line.startswith("#"):
-                # It's a commented line, store it
-                channel_info["commented_urls"].append(line)
-            else:
-                # The first non-commented line is the active URL
-                channel_info["url"] = line
+def parse_playlist(playlist_content: str) -> list[dict]:
+    """
+    Parses the content of an M3U playlist, including commented-out URLs,
+    into a list of dictionaries.
 
-        playlist_data.append(channel_info)
+    Args:
+        playlist_content: A string containing the M3U playlist data.
 
-    return playlist_data
+    Returns:
+        A list of dictionaries, where each dictionary represents a channel
+        and includes a list of any commented-out URLs.
+    """
+    return list(iter_playlist(playlist_content.splitlines()))
 
 
-def generate_playlist(playlist_data: list[dict]) -> str:
+def generate_playlist(
+    playlist_data: list[dict],
+    epg_url: str = EPG_URL,
+    logo_urls: Mapping[str, str] | None = None,
+) -> str:
     """
     Generates an M3U playlist string from a list of channel dictionaries,
     including commented-out URLs.
@@ -71,14 +133,15 @@ def generate_playlist(playlist_data: list[dict]) -> str:
     Args:
         playlist_data: A list of dictionaries representing channels.
                        Each dict can contain a 'commented_urls' list.
+        epg_url: The XMLTV guide referenced in the header.
+        logo_urls: Replacements for the channels' tvg-logo URLs (e.g. their
+                   mirrored copies), by original URL.
 
     Returns:
         A string containing the formatted M3U playlist.
     """
     # Start with the M3U header
-    playlist_parts = [
-        '#EXTM3U url-tvg="https://epgshare01.online/epgshare01/epg_ripper_US2.xml.gz"'
-    ]
+    playlist_parts = [f'#EXTM3U url-tvg="{epg_url}"']
 
     # Add a blank line if the source file had one (optional, for style)
     if any("url-tvg" in k for d in playlist_data for k in d):
@@ -89,14 +152,24 @@ def generate_playlist(playlist_data: list[dict]) -> str:
     for channel_info in playlist_data:
         attributes = []
         # Dynamically build attributes string from available keys
-        for key in ["tvg-id", "tvg-name", "tvg-logo", "group-title"]:
-            if channel_info.get(key):
-                attributes.append(f'{key}="{channel_info[key]}"')
+        for key in STANDARD_ATTRIBUTES:
+            value = channel_info.get(key)
+            if value:
+                if key == "tvg-logo" and logo_urls:
+                    value = logo_urls.get(value, value)
+                attributes.append(f'{key}="{value}"')
+
+        # Followed by any other attributes read from the source playlist
+        for key, value in (channel_info.get("attributes") or {}).items():
+            attributes.append(f'{key}="{value}"')
 
         attributes_str = " ".join(attributes)
 
         # Create the #EXTINF line
-        extinf_line = f'#EXTINF:-1 {attributes_str},{channel_info.get("name", "")}'
+        duration = channel_info.get("duration", -1)
+        extinf_line = (
+            f'#EXTINF:{duration} {attributes_str},{channel_info.get("name", "")}'
+        )
         playlist_parts.append(extinf_line)
 
         # Add any commented URLs
@@ -104,6 +177,11 @@ def generate_playlist(playlist_data: list[dict]) -> str:
             for commented_url in channel_info["commented_urls"]:
                 playlist_parts.append(commented_url)
 
+        # Add any VLC options, right before the URL they apply to
+        if channel_info.get("vlc_options"):
+            for vlc_option in channel_info["vlc_options"]:
+                playlist_parts.append(vlc_option)
+
         # Add the active URL
         if channel_info.get("url"):
             playlist_parts.append(channel_info["url"])
@@ -1,109 +1,44 @@
-import json
-import re
-from pprint import pprint
+import time
 
-from natsort import natsorted
-from ruamel.yaml import YAML
+# Taken before the other imports so the startup time includes them
+START: float = time.perf_counter()
 
-from check_streams import main as check_streams
-from DrewLive_parser import generate_drewlive_playlist
-from epg_generator import write_youtube_epg_file
-from m3u_utils import generate_playlist
-from youtube_utils import update_stream_urls, write_playlist
-from YTLive import main as yt_generator
+import argparse
+from typing import Callable
 
+import metrics
+from channel_store import ChannelStore
+from iptv_playlists import generate_full_iptv_playlist, generate_iptv_playlists
+from output_utils import get_changed_outputs
 
-def generate_iptv_playlists():
+
+class PipelineData:
     """
-    Updates the main playlist and specific playlists from the JSON data.
+    Data shared between pipeline stages. The channel store is opened at most
+    once and closed when the run is over.
     """
-    print("Starting IPTV playlist generation...")
-    with open("data/iptv_database.json", "r", encoding="utf-8") as f:
-        playlist_data = json.load(f)
-
-    # Update the main M3U file
-    playlist_content = generate_playlist(
-        natsorted(playlist_data, key=lambda ch: ch["name"].casefold())
-    )
-    with open("output/playlists/playlist_iptv.m3u", "w", encoding="utf-8") as f:
-        f.write(playlist_content)
-    print("Generated output/playlists/playlist_iptv.m3u")
 
-    # Update the working M3U file
-    with open("data/iptv_database_info.json", "r", encoding="utf-8") as f:
-        playlist_data = json.load(f)
+    def __init__(self) -> None:
+        self._store: ChannelStore | None = None
 
-    playlist_data = [channel for channel in playlist_data if channel["working"] is True]
+    @property
+    def store(self) -> ChannelStore:
+        if self._store is None:
+            self._store = ChannelStore.open()
+        return self._store
 
-    playlist_content = generate_playlist(
-        natsorted(playlist_data, key=lambda ch: ch["name"].casefold())
-    )
-    with open("output/playlists/playlist_iptv_working.m3u", "w", encoding="utf-8") as f:
-        f.write(playlist_content)
-    print("Generated output/playlists/playlist_iptv_working.m3u")
-
-    # Update specific playlists from YAML configuration
-    yaml = YAML(typ="safe")
-    with open("playlists.yaml", "r") as f:
-        playlists = yaml.load(f)
-
-    for playlist, data in playlists["playlists"].items():
-        channel_ids = data["ids"]
-        matching_channels = [
-            channel for channel in playlist_data if channel["tvg-id"] in channel_ids
-        ]
-        playlist_content = generate_playlist(matching_channels)
-        with open(f"output/playlists/{playlist}.m3u", "w", encoding="utf-8") as f:
-            f.write(playlist_content)
-        print(f"Generated output/playlists/{playlist}.m3u")
-
-    # Generate DrewLive playlist
-    generate_drewlive_playlist()
-
-    print("Finished IPTV playlist generation.")
-
-
-def generate_full_iptv_playlist():
-    with open("data/iptv_database.json", "r", encoding="utf-8") as f:
-        playlist_data = json.load(f)
-
-    full_playlist_data = []
-    seen_channel_urls = set()
-    for channel in playlist_data:
-        if not len(channel["commented_urls"]):
-            full_playlist_data.append(channel)
-        else:
-            urls = []
-            if channel["url"] not in seen_channel_urls:
-                urls.append(channel["url"])
-                seen_channel_urls.add(channel["url"])
-
-            for commented_url in channel["commented_urls"]:
-                url = re.sub(r"^#\s*", "", commented_url)
-                if url not in seen_channel_urls:
-                    urls.append(url)
-                    seen_channel_urls.add(url)
-
-            for enum, url in enumerate(urls, start=1):
-                new_channel = channel.copy()
-                new_channel["url"] = url
-                new_channel["tvg-name"] = f"{channel['tvg-name']} ({enum})"
-                new_channel["name"] = f"{channel['name']} ({enum})"
-                new_channel["commented_urls"] = []
-                full_playlist_data.append(new_channel)
-
-    playlist_content = generate_playlist(
-        natsorted(full_playlist_data, key=lambda ch: ch["name"].casefold())
-    )
-    with open("output/playlists/playlist_all.m3u", "w", encoding="utf-8") as f:
-        f.write(playlist_content)
-    print("Generated output/playlists/playlist_all.m3u")
+    def close(self) -> None:
+        if self._store is not None:
+            self._store.close()
+            self._store = None
 
 
 def generate_youtube_playlist():
     """
     Updates the YouTube streams and generates the corresponding M3U playlist.
     """
+    from youtube_utils import update_stream_urls, write_playlist
+
     update_stream_urls()
     write_playlist()
 
@@ -112,13 +47,137 @@ def generate_youtube_epg():
     """
     Generates the EPG for the YouTube streams.
     """
+    from epg_generator import write_youtube_epg_file
+
     write_youtube_epg_file()
 
 
-if __name__ == "__main__":
-    check_streams()
-    generate_iptv_playlists()
-    generate_full_iptv_playlist()
-    # generate_youtube_playlist()
+def run_check_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from check_streams import process_channels
+
+    process_channels(data.store, full=args.full, deep=args.deep)
+
+
+def run_logos_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from logo_mirror import get_logo_sources, mirror_logos
+
+    mirror_logos(get_logo_sources(data.store))
+
+
+def run_iptv_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    generate_iptv_playlists(data.store)
+
+
+def run_drewlive_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from DrewLive_parser import generate_drewlive_playlist
+
+    generate_drewlive_playlist()
+
+
+def run_full_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    generate_full_iptv_playlist(data.store)
+
+
+def run_guide_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from epg_merger import write_merged_epg
+
+    write_merged_epg(data.store.tvg_ids())
+
+
+def run_youtube_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from YTLive import main as yt_generator
+
     yt_generator()
+
+
+def run_epg_stage(data: PipelineData, args: argparse.Namespace) -> None:
     generate_youtube_epg()
+
+
+def run_watch_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from stream_watcher import watch
+
+    watch(data.store, duration=args.duration)
+
+
+def run_serve_stage(data: PipelineData, args: argparse.Namespace) -> None:
+    from playlist_server import serve
+
+    serve(args.host, args.port)
+
+
+# Stages in the order they run when several are selected
+STAGES: dict[str, Callable[[PipelineData, argparse.Namespace], None]] = {
+    "check": run_check_stage,
+    "logos": run_logos_stage,
+    "iptv": run_iptv_stage,
+    "drewlive": run_drewlive_stage,
+    "full": run_full_stage,
+    "guide": run_guide_stage,
+    "youtube": run_youtube_stage,
+    "epg": run_epg_stage,
+    "watch": run_watch_stage,
+    "serve": run_serve_stage,
+}
+# Long-running stages only run when asked for
+DEFAULT_STAGES: list[str] = [name for name in STAGES if name not in ("watch", "serve")]
+
+
+def format_duration(seconds: float) -> str:
+    m, s = divmod(seconds, 60)
+    return f"{m:.0f}m{s:.2f}s"
+
+
+def main(argv: list[str] | None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="Generate the IPTV playlists and EPG. Runs every stage except "
+        "watch and serve by default."
+    )
+    parser.add_argument(
+        "stages", nargs="*", metavar="stage", help=f"one of: {', '.join(STAGES)}"
+    )
+    parser.add_argument(
+        "--full", action="store_true", help="check: ignore the probe cache"
+    )
+    parser.add_argument(
+        "--deep",
+        action="store_true",
+        help="check: also download the first segments of working streams",
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="serve: address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="serve: port")
+    parser.add_argument(
+        "--duration", type=float, help="watch: stop after this many seconds"
+    )
+    args = parser.parse_intermixed_args(argv)
+    for name in args.stages:
+        if name not in STAGES:
+            parser.error(f"unknown stage '{name}'")
+    metrics.record_stage("startup", time.perf_counter() - START)
+    print(f"Started in {format_duration(time.perf_counter() - START)}")
+
+    selected: set[str] = set(args.stages or DEFAULT_STAGES)
+    data = PipelineData()
+    try:
+        for name, stage in STAGES.items():
+            if name not in selected:
+                continue
+            start: float = time.perf_counter()
+            stage(data, args)
+            end: float = time.perf_counter()
+            metrics.record_stage(name, end - start)
+            print(f"Stage '{name}' done in {format_duration(end - start)}")
+    finally:
+        data.close()
+
+    metrics.write_report()
+    changed_outputs: list[str] = get_changed_outputs()
+    print(f"{len(changed_outputs)} output file(s) changed")
+    for path in changed_outputs:
+        print(f"  {path}")
+
+    print(f"Done in {format_duration(time.perf_counter() - START)}")
+
+
+if __name__ == "__main__":
+    main()
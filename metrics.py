@@ -0,0 +1,106 @@
+import json
+import math
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Iterator
+
+from output_utils import write_output
+
+RUN_REPORT_PATH: str = "output/run_report.json"
+
+_lock = threading.Lock()
+_started: datetime = datetime.now(timezone.utc)
+_stages: dict[str, float] = {}
+_counters: defaultdict[str, int] = defaultdict(int)
+# category -> host -> durations in seconds
+_latencies: defaultdict[str, defaultdict[str, list[float]]] = defaultdict(
+    lambda: defaultdict(list)
+)
+
+
+def increment(counter: str, amount: int = 1) -> None:
+    with _lock:
+        _counters[counter] += amount
+
+
+def record_latency(category: str, seconds: float, host: str = "") -> None:
+    with _lock:
+        _latencies[category][host].append(seconds)
+
+
+def record_stage(name: str, seconds: float) -> None:
+    with _lock:
+        _stages[name] = round(seconds, 3)
+
+
+@contextmanager
+def timed(category: str, host: str = "") -> Iterator[None]:
+    """
+    Records how long the block takes as a latency of `category` on `host`.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_latency(category, time.perf_counter() - start, host)
+
+
+def reset() -> None:
+    """
+    Forgets everything recorded so far, e.g. between benchmark runs.
+    """
+    global _started
+    with _lock:
+        _started = datetime.now(timezone.utc)
+        _stages.clear()
+        _counters.clear()
+        _latencies.clear()
+
+
+def percentile(values: list[float], p: float) -> float:
+    """
+    Nearest-rank percentile of a non-empty list.
+    """
+    ordered = sorted(values)
+    rank = max(math.ceil(p / 100 * len(ordered)), 1)
+    return ordered[rank - 1]
+
+
+def summarize(values: list[float]) -> dict[str, float]:
+    return {
+        "count": len(values),
+        "p50": round(percentile(values, 50), 3),
+        "p95": round(percentile(values, 95), 3),
+        "max": round(max(values), 3),
+        "total": round(sum(values), 3),
+    }
+
+
+def build_report() -> dict:
+    with _lock:
+        latencies = {}
+        for category, hosts in sorted(_latencies.items()):
+            all_values = [value for values in hosts.values() for value in values]
+            # Slowest hosts first, since they are the ones worth looking at
+            by_host = sorted(hosts.items(), key=lambda item: -sum(item[1]))
+            latencies[category] = {
+                "overall": summarize(all_values),
+                "hosts": {host: summarize(values) for host, values in by_host},
+            }
+
+        return {
+            "started": _started.isoformat(timespec="seconds"),
+            "duration_s": round(
+                (datetime.now(timezone.utc) - _started).total_seconds(), 3
+            ),
+            "stages": dict(_stages),
+            "counters": dict(sorted(_counters.items())),
+            "latencies": latencies,
+        }
+
+
+def write_report(path: str = RUN_REPORT_PATH) -> None:
+    write_output(path, json.dumps(build_report(), indent=2) + "\n")
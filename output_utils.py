@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Iterable
+
+MANIFEST_PATH: str = "output/.manifest.json"
+
+_lock = threading.Lock()
+_changed_outputs: list[str] = []
+
+
+def load_manifest(path: str = MANIFEST_PATH) -> dict[str, str]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: dict[str, str], path: str = MANIFEST_PATH) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+
+def hash_file(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def write_output(
+    path: str,
+    content: str | bytes | Iterable[str | bytes],
+    manifest_path: str = MANIFEST_PATH,
+) -> bool:
+    """
+    Writes an output file only if its content changed.
+
+    The content is streamed to a temporary file next to `path` while it is
+    hashed. If the hash matches the one recorded in the manifest, the
+    temporary file is discarded and `path` is left untouched; otherwise it
+    atomically replaces `path`.
+
+    Args:
+        path: The output file to write.
+        content: The file content, either whole or as an iterable of chunks.
+                 Strings are encoded as UTF-8.
+        manifest_path: The JSON file holding the hash of every output.
+
+    Returns:
+        True if the file was written, False if it was unchanged.
+    """
+    if isinstance(content, (str, bytes)):
+        content = [content]
+
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+
+    sha256 = hashlib.sha256()
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in content:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode("utf-8")
+                sha256.update(chunk)
+                f.write(chunk)
+        digest = sha256.hexdigest()
+
+        with _lock:
+            manifest = load_manifest(manifest_path)
+            key = path.replace(os.sep, "/")
+            previous = manifest.get(key)
+            if previous is None and os.path.exists(path):
+                previous = hash_file(path)
+
+            if previous == digest and os.path.exists(path):
+                os.remove(temp_path)
+                changed = False
+            else:
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+                _changed_outputs.append(path)
+                changed = True
+
+            if manifest.get(key) != digest:
+                manifest[key] = digest
+                save_manifest(manifest, manifest_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+    print(f"Generated {path}" if changed else f"Unchanged {path}")
+    return changed
+
+
+def get_changed_outputs() -> list[str]:
+    """
+    Returns the outputs written by this process, in the order they were written.
+    """
+    with _lock:
+        return list(_changed_outputs)
@@ -0,0 +1,329 @@
+import gzip
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from channel_store import STORE_PATH, Channel, ChannelStore
+from iptv_playlists import sort_channels
+from logo_index import LOGO_INDEX_PATH, load_logo_urls
+from m3u_utils import generate_playlist
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+OUTPUT_DIR: str = "output"
+DEFAULT_HOST: str = "0.0.0.0"
+DEFAULT_PORT: int = 8080
+# Rendered responses kept in memory, across all paths, filters and encodings
+MAX_CACHE_ENTRIES: int = 256
+# Responses smaller than this aren't worth compressing
+MIN_COMPRESS_BYTES: int = 1024
+
+CONTENT_TYPES: dict[str, str] = {
+    ".m3u": "audio/x-mpegurl; charset=utf-8",
+    ".m3u8": "application/vnd.apple.mpegurl; charset=utf-8",
+    ".xml": "application/xml; charset=utf-8",
+    ".json": "application/json; charset=utf-8",
+    ".gz": "application/gzip",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".gif": "image/gif",
+    ".webp": "image/webp",
+    ".ico": "image/x-icon",
+    ".svg": "image/svg+xml",
+}
+# Files that are already compressed
+COMPRESSED_EXTENSIONS: tuple[str, ...] = (
+    ".gz",
+    ".png",
+    ".jpg",
+    ".gif",
+    ".webp",
+    ".ico",
+)
+
+
+class Response:
+    __slots__ = ("body", "etag", "content_type", "encoding")
+
+    def __init__(
+        self, body: bytes, etag: str, content_type: str, encoding: str | None = None
+    ) -> None:
+        self.body = body
+        self.etag = etag
+        self.content_type = content_type
+        self.encoding = encoding
+
+
+class RenderCache:
+    """
+    Thread-safe LRU cache of rendered responses.
+    """
+
+    def __init__(self, max_entries: int = MAX_CACHE_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple, Response] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: tuple) -> Response | None:
+        with self._lock:
+            response = self._entries.get(key)
+            if response is not None:
+                self._entries.move_to_end(key)
+            return response
+
+    def put(self, key: tuple, response: Response) -> None:
+        with self._lock:
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def get_accepted_encoding(accept_encoding: str) -> str | None:
+    """
+    Picks the best encoding the client accepts: brotli (if installed), then
+    gzip, then none.
+    """
+    accepted: set[str] = set()
+    for part in accept_encoding.split(","):
+        name, _, params = part.strip().partition(";")
+        if params.strip().replace(" ", "") in ("q=0", "q=0.0"):
+            continue
+        accepted.add(name.strip().lower())
+    if brotli is not None and "br" in accepted:
+        return "br"
+    if "gzip" in accepted or "*" in accepted:
+        return "gzip"
+    return None
+
+
+def encode_response(response: Response, encoding: str | None) -> Response:
+    """
+    Compresses a response. Each encoding gets its own strong ETag.
+    """
+    if encoding is None or len(response.body) < MIN_COMPRESS_BYTES:
+        return response
+    if encoding == "br":
+        body = brotli.compress(response.body)
+    else:
+        body = gzip.compress(response.body, mtime=0)
+    etag = f'{response.etag[:-1]}-{encoding}"'
+    return Response(body, etag, response.content_type, encoding)
+
+
+def make_response(body: bytes, content_type: str) -> Response:
+    etag = '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+    return Response(body, etag, content_type)
+
+
+def filter_channels(
+    channels: list[Channel],
+    groups: list[str],
+    tvg_ids: list[str],
+    min_height: int | None,
+) -> list[Channel]:
+    group_set = set(groups)
+    id_set = set(tvg_ids)
+    return [
+        channel
+        for channel in channels
+        if (not group_set or channel.group_title in group_set)
+        and (not id_set or channel.tvg_id in id_set)
+        and (min_height is None or (channel.height or 0) >= min_height)
+    ]
+
+
+class PlaylistServer:
+    """
+    Serves the generated files under output/ and playlists rendered from the
+    channel store on demand, from an in-memory cache.
+
+    Routes:
+        /playlist.m3u: A playlist of the channels matching the query:
+                       `group` (group-title, repeatable), `tvg_id`
+                       (comma-separated or repeatable), `working=1` and
+                       `min_height`.
+        /<path>: The file at output/<path>, e.g. /playlists/playlist_iptv.m3u,
+                 /youtube_epg.xml or a mirrored logo under /logos/.
+    """
+
+    def __init__(
+        self, store_path: str = STORE_PATH, output_dir: str = OUTPUT_DIR
+    ) -> None:
+        self.store_path = store_path
+        self.output_dir = os.path.abspath(output_dir)
+        self.cache = RenderCache()
+        self._lock = threading.Lock()
+        self._generation: tuple[int, int] | None = None
+        self._database: list[Channel] = []
+        self._working: list[Channel] = []
+        self._logo_urls: dict[str, str] = {}
+
+    def refresh(self) -> tuple[int, int]:
+        """
+        Reloads the channels and mirrored logos if the store's data version or
+        the logo index changed since they were loaded. Playlists are cached
+        under the returned generation, so the ones rendered from the old data
+        are no longer used and age out of the cache.
+        """
+        logo_mtime = 0
+        if os.path.exists(LOGO_INDEX_PATH):
+            logo_mtime = os.stat(LOGO_INDEX_PATH).st_mtime_ns
+        with self._lock:
+            # Read-only, so a request never imports or writes anything
+            with ChannelStore.open_readonly(self.store_path) as store:
+                generation = (store.get_data_version(), logo_mtime)
+                if generation != self._generation:
+                    self._database = store.channels()
+                    self._working = store.channels("info", working=True)
+            if generation != self._generation:
+                self._logo_urls = load_logo_urls()
+                self._generation = generation
+                print(f"Loaded {len(self._database)} channels from {self.store_path}")
+            return self._generation
+
+    def render_playlist(self, query: str) -> Response:
+        params = parse_qs(query)
+        groups = params.get("group", [])
+        tvg_ids = [
+            tvg_id for value in params.get("tvg_id", []) for tvg_id in value.split(",")
+        ]
+        working = params.get("working", ["0"])[-1].lower() in ("1", "true", "yes")
+        min_height = params.get("min_height", [None])[-1]
+        min_height = int(min_height) if min_height is not None else None
+
+        channels = self._working if working else self._database
+        channels = filter_channels(channels, groups, tvg_ids, min_height)
+        content = generate_playlist(sort_channels(channels), logo_urls=self._logo_urls)
+        body = content.encode("utf-8")
+        return make_response(body, CONTENT_TYPES[".m3u"])
+
+    def resolve_file(self, path: str) -> tuple[str, tuple]:
+        """
+        Maps a request path to a file under the output directory. Returns the
+        file and its cache key, which changes whenever the file does.
+        """
+        full_path = os.path.abspath(os.path.join(self.output_dir, path.lstrip("/")))
+        if not full_path.startswith(self.output_dir + os.sep):
+            raise FileNotFoundError(path)
+        stat = os.stat(full_path)
+        return full_path, ("file", full_path, stat.st_mtime_ns, stat.st_size)
+
+    def read_file(self, full_path: str) -> Response:
+        with open(full_path, "rb") as f:
+            body = f.read()
+        content_type = CONTENT_TYPES.get(
+            os.path.splitext(full_path)[1], "application/octet-stream"
+        )
+        return make_response(body, content_type)
+
+    def get(self, target: str, accept_encoding: str) -> Response:
+        """
+        Returns the response for a request target, compressed for the client.
+        Raises FileNotFoundError or ValueError for unknown paths or bad
+        queries.
+        """
+        url = urlsplit(target)
+        path = unquote(url.path)
+        encoding = get_accepted_encoding(accept_encoding)
+
+        if path == "/playlist.m3u":
+            key = ("playlist", self.refresh(), url.query)
+            response = self.cache.get(key + (None,))
+            if response is None:
+                response = self.render_playlist(url.query)
+                self.cache.put(key + (None,), response)
+        else:
+            full_path, key = self.resolve_file(path)
+            response = self.cache.get(key + (None,))
+            if response is None:
+                response = self.read_file(full_path)
+                self.cache.put(key + (None,), response)
+            if full_path.endswith(COMPRESSED_EXTENSIONS):
+                encoding = None
+
+        if encoding is None:
+            return response
+        encoded = self.cache.get(key + (encoding,))
+        if encoded is None:
+            encoded = encode_response(response, encoding)
+            self.cache.put(key + (encoding,), encoded)
+        return encoded
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "CrIPTV"
+    # Every response has a Content-Length, so clients can reuse connections
+    protocol_version = "HTTP/1.1"
+    app: PlaylistServer
+
+    def do_GET(self) -> None:
+        self.respond(send_body=True)
+
+    def do_HEAD(self) -> None:
+        self.respond(send_body=False)
+
+    def respond(self, send_body: bool) -> None:
+        try:
+            response = self.app.get(self.path, self.headers.get("Accept-Encoding", ""))
+        except (FileNotFoundError, IsADirectoryError):
+            self.send_error(HTTPStatus.NOT_FOUND)
+            return
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST)
+            return
+
+        if_none_match = self.headers.get("If-None-Match", "")
+        etags = {tag.strip() for tag in if_none_match.split(",")}
+        not_modified = response.etag in etags or "*" in etags
+        self.send_response(HTTPStatus.NOT_MODIFIED if not_modified else HTTPStatus.OK)
+        self.send_header("ETag", response.etag)
+        self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Cache-Control", "no-cache")
+        if not not_modified:
+            self.send_header("Content-Type", response.content_type)
+            self.send_header("Content-Length", str(len(response.body)))
+            if response.encoding:
+                self.send_header("Content-Encoding", response.encoding)
+        self.end_headers()
+        if send_body and not not_modified:
+            self.wfile.write(response.body)
+
+    def log_request(self, code="-", size="-") -> None:
+        # Polling clients would flood the log, so only failures are logged
+        if isinstance(code, int) and code >= 400:
+            super().log_request(code, size)
+
+
+def serve(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    store_path: str = STORE_PATH,
+    output_dir: str = OUTPUT_DIR,
+) -> None:
+    # Create the store, or import an edited iptv_database.json, before serving
+    ChannelStore.open(store_path).close()
+    app = PlaylistServer(store_path, output_dir)
+    app.refresh()
+    handler = type("Handler", (RequestHandler,), {"app": app})
+    with ThreadingHTTPServer((host, port), handler) as server:
+        print(f"Serving on http://{host}:{port}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    serve()
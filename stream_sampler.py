@@ -0,0 +1,196 @@
+import time
+from typing import Any
+from urllib.parse import urljoin
+
+import httpx
+
+import metrics
+from channel_store import get_host
+from check_streams import (
+    HOST_FAILURE_REASONS,
+    MAX_PER_HOST,
+    MAX_WORKERS,
+    classify_http_error,
+    create_http_client,
+    fetch_hls_manifest,
+    iter_manifest_variants,
+    run_probes,
+)
+
+# How many segments of each stream are downloaded, and how much of each
+SAMPLE_SEGMENTS: int = 3
+MAX_SEGMENT_BYTES: int = 16 * 1024 * 1024
+SEGMENT_TIMEOUT: httpx.Timeout = httpx.Timeout(20.0, connect=10.0)
+
+
+def get_segments(playlist: str, playlist_url: str) -> list[tuple[str, float]]:
+    """
+    Reads the segment URLs of an HLS media playlist and their durations.
+    """
+    segments: list[tuple[str, float]] = []
+    duration: float | None = None
+    for line in playlist.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            try:
+                duration = float(line[len("#EXTINF:") :].split(",")[0])
+            except ValueError:
+                duration = 0.0
+        elif duration is not None and line and not line.startswith("#"):
+            segments.append((urljoin(playlist_url, line), duration))
+            duration = None
+    return segments
+
+
+def get_best_variant(manifest: str, url: str) -> tuple[str, int | None]:
+    """
+    Returns the URL and declared bandwidth of the highest quality variant of a
+    master playlist, or `url` itself if it is a media playlist.
+    """
+    best: tuple[tuple[int, float, int], str, int | None] | None = None
+    for attributes, uri in iter_manifest_variants(manifest):
+        try:
+            height = int(attributes.get("RESOLUTION", "0x0").lower().split("x")[1])
+            fps = float(attributes.get("FRAME-RATE", 0))
+        except (IndexError, ValueError):
+            height, fps = 0, 0.0
+        bandwidth = attributes.get("BANDWIDTH", "")
+        bandwidth = int(bandwidth) if bandwidth.isdigit() else None
+        key = (height, fps, bandwidth or 0)
+        if best is None or key > best[0]:
+            best = (key, urljoin(url, uri), bandwidth)
+
+    if best is None:
+        return url, None
+    return best[1], best[2]
+
+
+def download_segment(url: str, client: httpx.Client) -> int:
+    """
+    Downloads a segment (up to MAX_SEGMENT_BYTES) and returns its size.
+    Raises httpx.HTTPError if the request fails.
+    """
+    with client.stream("GET", url, timeout=SEGMENT_TIMEOUT) as response:
+        try:
+            response.raise_for_status()
+            size = 0
+            for chunk in response.iter_bytes():
+                size += len(chunk)
+                if size >= MAX_SEGMENT_BYTES:
+                    break
+            return size
+        finally:
+            metrics.increment("bytes_downloaded", response.num_bytes_downloaded)
+
+
+def sample_stream(
+    url: str, client: httpx.Client, segments: int = SAMPLE_SEGMENTS
+) -> dict[str, Any] | None:
+    """
+    Downloads the first segments of an HLS stream's best variant and measures
+    how watchable it is.
+
+    Returns:
+        None if the URL is not an HLS playlist, otherwise:
+        time_to_first_segment: Seconds from requesting the playlist until the
+                               first segment was downloaded.
+        bitrate: The stream's bitrate measured from the segments (bits/s).
+        bandwidth: The bitrate the master playlist declares for the variant.
+        throughput: The download rate of the segments (bits/s).
+        throughput_ratio: `throughput` relative to the declared (or measured)
+                          bitrate. Below 1 the stream can't play in real time.
+        segments: The number of segments requested.
+        segment_errors: The number of segment downloads that failed.
+        error: Why the stream couldn't be sampled, if it couldn't.
+    """
+    host = get_host(url)
+    start = time.perf_counter()
+    try:
+        manifest = fetch_hls_manifest(url, client)
+        if manifest is None:
+            return None
+        media_url, bandwidth = get_best_variant(manifest, url)
+        playlist = manifest
+        if media_url != url:
+            playlist = fetch_hls_manifest(media_url, client)
+            if playlist is None:
+                return {"error": "no_video"}
+    except httpx.HTTPError as e:
+        return {"error": classify_http_error(e)}
+
+    sampled = get_segments(playlist, media_url)[:segments]
+    if not sampled:
+        return {"error": "no_video"}
+
+    time_to_first_segment: float | None = None
+    segment_errors = 0
+    downloaded = 0
+    download_time = 0.0
+    media_duration = 0.0
+    for segment_url, duration in sampled:
+        segment_start = time.perf_counter()
+        try:
+            size = download_segment(segment_url, client)
+        except httpx.HTTPError:
+            segment_errors += 1
+            continue
+        segment_end = time.perf_counter()
+        metrics.record_latency("segment", segment_end - segment_start, host)
+        if time_to_first_segment is None:
+            time_to_first_segment = segment_end - start
+        downloaded += size
+        download_time += segment_end - segment_start
+        media_duration += duration
+
+    quality: dict[str, Any] = {
+        "time_to_first_segment": (
+            round(time_to_first_segment, 3)
+            if time_to_first_segment is not None
+            else None
+        ),
+        "bitrate": round(downloaded * 8 / media_duration) if media_duration else None,
+        "bandwidth": bandwidth,
+        "throughput": round(downloaded * 8 / download_time) if download_time else None,
+        "throughput_ratio": None,
+        "segments": len(sampled),
+        "segment_errors": segment_errors,
+    }
+    reference = bandwidth or quality["bitrate"]
+    if quality["throughput"] and reference:
+        quality["throughput_ratio"] = round(quality["throughput"] / reference, 2)
+    return quality
+
+
+def is_sample_failure(quality: dict[str, Any] | None) -> bool:
+    return (quality or {}).get("error") in HOST_FAILURE_REASONS
+
+
+def report_sample_host_down(host: str, skipped: list[str]) -> None:
+    print(f"{host} looks down, skipping {len(skipped)} samples")
+    metrics.increment("sample_hosts_down")
+    metrics.increment("samples_skipped_host_down", len(skipped))
+
+
+def sample_streams(
+    urls: list[str], max_workers: int = MAX_WORKERS, per_host: int = MAX_PER_HOST
+) -> dict[str, dict[str, Any] | None]:
+    """
+    Samples the streams concurrently, with the same per-host limits and
+    circuit breaker as the probes.
+    """
+    start = time.perf_counter()
+    with create_http_client(max_workers) as client:
+        results = run_probes(
+            urls,
+            lambda url: sample_stream(url, client),
+            max_workers=max_workers,
+            per_host=per_host,
+            is_failure=is_sample_failure,
+            host_down=lambda url: {"error": "host_down"},
+            probe_error=lambda url, error: {"error": "probe_error"},
+            on_host_down=report_sample_host_down,
+        )
+    elapsed = time.perf_counter() - start
+    print(f"Sampled {len(results)} streams in {elapsed:.2f}s")
+    metrics.increment("streams_sampled", len(results))
+    return results
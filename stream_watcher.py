@@ -0,0 +1,221 @@
+import heapq
+import time
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any
+
+import metrics
+from channel_store import ChannelStore, get_candidate_urls
+from check_streams import (
+    create_http_client,
+    get_failure_backoff,
+    get_probe_timeout,
+    probe_error_result,
+    probe_url,
+    update_cache_entry,
+)
+from iptv_playlists import generate_iptv_playlists
+from rate_limiter import TokenBucket
+
+# Probes per second. The watcher probes at this steady rate instead of
+# sweeping every stream at once.
+WATCH_RATE: float = 0.5
+WATCH_WORKERS: int = 4
+# How often working streams are re-checked. Channels in the playlists.yaml
+# playlists are popular and checked more often.
+HEALTHY_INTERVAL: float = 3600
+POPULAR_INTERVAL: float = 900
+# Streams whose status changed within their last FLAP_WINDOW checks are
+# flapping, and are re-checked at least this often, even if they are down
+FLAPPING_INTERVAL: float = 300
+FLAP_WINDOW: int = 4
+# Status flips are batched for this long before the playlists are updated
+REGENERATE_DELAY: float = 30
+
+
+def load_popular_ids(path: str = "playlists.yaml") -> set[str]:
+    from ruamel.yaml import YAML
+
+    yaml = YAML(typ="safe")
+    with open(path, "r") as f:
+        playlists = yaml.load(f)
+    return {
+        channel_id
+        for data in playlists["playlists"].values()
+        for channel_id in data["ids"]
+    }
+
+
+def is_flapping(history: deque[bool]) -> bool:
+    return len(set(history)) > 1
+
+
+def get_check_interval(
+    entry: dict[str, Any], popular: bool, history: deque[bool]
+) -> float:
+    """
+    Returns how long to wait before checking a URL again.
+    """
+    failures: int = entry.get("failures", 0)
+    if failures == 0:
+        interval = POPULAR_INTERVAL if popular else HEALTHY_INTERVAL
+    else:
+        interval = get_failure_backoff(failures)
+    if is_flapping(history):
+        interval = min(interval, FLAPPING_INTERVAL)
+    return interval
+
+
+class StreamWatcher:
+    """
+    Continuously re-checks the streams of the channel store, each when it is
+    due, and updates the playlists that depend on a channel whose working
+    status flips.
+    """
+
+    def __init__(
+        self,
+        store: ChannelStore,
+        rate: float = WATCH_RATE,
+        max_workers: int = WATCH_WORKERS,
+        popular_ids: set[str] | None = None,
+    ) -> None:
+        self.store = store
+        self.max_workers = max_workers
+        self.limiter = TokenBucket(rate, 1)
+        self.probes: dict[str, dict[str, Any]] = store.load_probes()
+        self.history: defaultdict[str, deque[bool]] = defaultdict(
+            lambda: deque(maxlen=FLAP_WINDOW)
+        )
+        self.changed_ids: set[str] = set()
+        self.first_change: float | None = None
+
+        if popular_ids is None:
+            popular_ids = load_popular_ids()
+        # The channels each URL is a source of
+        self.url_positions: defaultdict[str, list[int]] = defaultdict(list)
+        self.popular_urls: set[str] = set()
+        for channel in store.channels():
+            for url in get_candidate_urls(channel):
+                self.url_positions[url].append(channel.position)
+                if channel.tvg_id in popular_ids:
+                    self.popular_urls.add(url)
+
+        # (next check time, URL), soonest first
+        self.queue: list[tuple[float, str]] = []
+        for url in self.url_positions:
+            entry = self.probes.get(url)
+            due = entry["checked"] + self.get_interval(url) if entry else 0.0
+            self.queue.append((due, url))
+        heapq.heapify(self.queue)
+
+    def get_interval(self, url: str) -> float:
+        return get_check_interval(
+            self.probes[url], url in self.popular_urls, self.history[url]
+        )
+
+    def record(self, url: str, probe: dict[str, Any]) -> None:
+        """
+        Stores a probe result, updates the status of the channels using the
+        URL and schedules its next check.
+        """
+        now = time.time()
+        entry = update_cache_entry(self.probes.get(url), probe, now)
+        self.probes[url] = entry
+        self.history[url].append(entry["result"] is not None)
+        self.store.save_probe(url, entry)
+        metrics.increment("streams_probed")
+
+        flipped = self.store.refresh_status(self.probes, self.url_positions[url])
+        for channel in flipped:
+            state = "down" if channel.working else "up"
+            print(f"{channel.name} is {state} ({url})")
+            self.changed_ids.add(channel.tvg_id)
+            metrics.increment("status_flips")
+        if flipped and self.first_change is None:
+            self.first_change = time.monotonic()
+
+        heapq.heappush(self.queue, (now + self.get_interval(url), url))
+
+    def regenerate(self) -> None:
+        """
+        Exports the updated stream info and rewrites the playlists affected by
+        the channels that flipped.
+        """
+        self.store.export_json()
+        generate_iptv_playlists(self.store, self.changed_ids)
+        self.changed_ids = set()
+        self.first_change = None
+
+    def run(self, duration: float | None = None) -> None:
+        """
+        Watches the streams until interrupted, or for `duration` seconds.
+        """
+        end = time.monotonic() + duration if duration is not None else None
+        futures: dict[Future, str] = {}
+        print(f"Watching {len(self.queue)} streams")
+
+        client = create_http_client(self.max_workers)
+        with client, ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while end is None or time.monotonic() < end:
+                while (
+                    self.queue
+                    and self.queue[0][0] <= time.time()
+                    and len(futures) < self.max_workers
+                ):
+                    _, url = heapq.heappop(self.queue)
+                    self.limiter.acquire()
+                    timeout = get_probe_timeout(self.probes.get(url))
+                    futures[pool.submit(probe_url, url, client, timeout)] = url
+
+                # Wake up for the next due URL, a finished probe or a pending
+                # playlist update, whichever comes first
+                wait_time = 1.0
+                if self.queue and len(futures) < self.max_workers:
+                    wait_time = min(wait_time, max(self.queue[0][0] - time.time(), 0))
+                if futures:
+                    done, _ = wait(futures, wait_time, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url = futures.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            print(f"Probe of {url} failed: {e!r}")
+                            result = probe_error_result(url, e)
+                        self.record(url, result)
+                else:
+                    time.sleep(wait_time)
+
+                if (
+                    self.first_change is not None
+                    and time.monotonic() - self.first_change >= REGENERATE_DELAY
+                ):
+                    self.regenerate()
+
+            for future in futures:
+                future.cancel()
+
+        if self.changed_ids:
+            self.regenerate()
+
+
+def watch(
+    store: ChannelStore | None = None,
+    rate: float = WATCH_RATE,
+    max_workers: int = WATCH_WORKERS,
+    duration: float | None = None,
+) -> None:
+    if store is None:
+        with ChannelStore.open() as store:
+            return watch(store, rate, max_workers, duration)
+
+    watcher = StreamWatcher(store, rate, max_workers)
+    try:
+        watcher.run(duration)
+    except KeyboardInterrupt:
+        if watcher.changed_ids:
+            watcher.regenerate()
+
+
+if __name__ == "__main__":
+    watch()
@@ -0,0 +1,89 @@
+import json
+import os
+import re
+import time
+from typing import Any
+from urllib.parse import parse_qs, urlsplit
+
+# Resolved YouTube stream URLs, keyed by video ID. YTLive keeps the yt-dlp
+# info of each live as an entry's metadata and youtube_utils keeps its
+# youtube_channels.json item, so they use separate files.
+YOUTUBE_CACHE_PATH: str = "data/youtube_cache.json"
+YOUTUBE_CHANNELS_CACHE_PATH: str = "data/youtube_channels_cache.json"
+# A published URL has to stay valid until the next run has replaced it: one
+# cron interval (every 3 hours) plus the time the run takes to finish and push
+PUBLISH_INTERVAL: int = 3 * 3600
+RUN_DURATION: int = 3600
+# Entries are re-resolved once their URL is this close to expiring. googlevideo
+# URLs expire about 6 hours after they are resolved, so an entry is only
+# reused for about 2 hours: by manual or push-triggered runs, never by the
+# next scheduled run, which always resolves the URLs again.
+EXPIRY_MARGIN: int = PUBLISH_INTERVAL + RUN_DURATION
+
+# googlevideo URLs carry their expiry either as a query parameter or, for HLS
+# manifests, as a path segment (.../expire/1700000000/...)
+EXPIRE_PATH_PATTERN = re.compile(r"/expire/(\d+)")
+
+
+def load_youtube_cache(path: str = YOUTUBE_CACHE_PATH) -> dict[str, dict[str, Any]]:
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_youtube_cache(
+    cache: dict[str, dict[str, Any]], path: str = YOUTUBE_CACHE_PATH
+) -> None:
+    # Expired URLs are useless, so they are dropped instead of saved
+    now = time.time()
+    cache = {
+        video_id: entry
+        for video_id, entry in cache.items()
+        if entry.get("expire") and entry["expire"] > now
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+
+
+def parse_expiry(url: str) -> int | None:
+    """
+    Returns the expiry of a googlevideo URL as a Unix timestamp, or None if
+    the URL has no expiry.
+    """
+    parts = urlsplit(url)
+    expire = parse_qs(parts.query).get("expire", [None])[0]
+    if expire is None:
+        match = EXPIRE_PATH_PATTERN.search(parts.path)
+        expire = match.group(1) if match else None
+    return int(expire) if expire and expire.isdigit() else None
+
+
+def make_cache_entry(direct_url: str, metadata: dict) -> dict[str, Any]:
+    # `yt-dlp -g` prints one URL per format; they share the same expiry
+    first_url = direct_url.splitlines()[0] if direct_url else ""
+    return {
+        "direct_url": direct_url,
+        "expire": parse_expiry(first_url),
+        "resolved": time.time(),
+        "metadata": metadata,
+    }
+
+
+def get_cached_entry(
+    cache: dict[str, dict[str, Any]], video_id: str, max_age: float | None = None
+) -> dict[str, Any] | None:
+    """
+    Returns the cache entry of a video if its URL isn't close to expiring and,
+    if `max_age` is given, it was resolved less than `max_age` seconds ago.
+    """
+    entry = cache.get(video_id)
+    if entry is None or not entry.get("expire"):
+        return None
+
+    now = time.time()
+    if entry["expire"] - now < EXPIRY_MARGIN:
+        return None
+    if max_age is not None and now - entry["resolved"] > max_age:
+        return None
+    return entry
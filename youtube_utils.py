@@ -1,11 +1,24 @@
 import json
 import subprocess
-import time
 
+from logo_index import load_logo_urls
 from m3u_utils import generate_playlist
+from output_utils import write_output
+from rate_limiter import TokenBucket
+from youtube_cache import (
+    YOUTUBE_CHANNELS_CACHE_PATH,
+    get_cached_entry,
+    load_youtube_cache,
+    make_cache_entry,
+    save_youtube_cache,
+)
+
+# At most one yt-dlp call every 3 seconds
+YT_DLP_LIMITER: TokenBucket = TokenBucket(rate=1 / 3)
 
 
 def get_youtube_stream_url(url: str) -> str:
+    YT_DLP_LIMITER.acquire()
     p = subprocess.run(
         ["yt-dlp", "--cookies-from-browser", "firefox", "-g", url],
         stdout=subprocess.PIPE,
@@ -17,27 +30,36 @@ def update_stream_urls():
     with open("data/youtube_channels.json", "r", encoding="utf-8") as f:
         data_template = json.load(f)
 
+    cache = load_youtube_cache(YOUTUBE_CHANNELS_CACHE_PATH)
     updated_data = []
     for item in data_template:
-        url = get_youtube_stream_url(
-            f"https://www.youtube.com/watch?v={item['tvg-id']}"
-        )
+        video_id = item["tvg-id"]
+        entry = get_cached_entry(cache, video_id)
+        if entry is not None:
+            item["url"] = entry["direct_url"]
+            updated_data.append(item)
+            continue
+
+        url = get_youtube_stream_url(f"https://www.youtube.com/watch?v={video_id}")
         if not url:
-            print(f"[{item['tvg-id']}]", item["name"], "not found")
+            print(f"[{video_id}]", item["name"], "not found")
             continue
         item["url"] = url
         updated_data.append(item)
-        time.sleep(3)
+        cache[video_id] = make_cache_entry(url, item)
 
+    save_youtube_cache(cache, YOUTUBE_CHANNELS_CACHE_PATH)
     with open("data/youtube_channels.json", "w", encoding="utf-8") as f:
         json.dump(updated_data, f, indent=2)
 
 
 def write_playlist():
-    with open("output/playlists/playlist_youtube.m3u", "w", encoding="utf-8") as fl:
-        with open("data/youtube_channels.json", "r", encoding="utf-8") as f:
-            streams_data = json.load(f)
-        fl.write(generate_playlist(streams_data))
+    with open("data/youtube_channels.json", "r", encoding="utf-8") as f:
+        streams_data = json.load(f)
+    write_output(
+        "output/playlists/playlist_youtube.m3u",
+        generate_playlist(streams_data, logo_urls=load_logo_urls()),
+    )
 
 
 if __name__ == "__main__":